@@ -1,9 +1,11 @@
 from flask import Flask, request, jsonify
-import json
-import os
-import hashlib
-import time
 from flask_cors import CORS
+import argparse
+import atexit
+import os
+
+import tracker_api
+from tracker_store import TrackerStore
 
 app = Flask(__name__)
 CORS(app)
@@ -15,164 +17,112 @@ CORS(app)
 #     "filename": "example.mp4",
 #     "size": 123456,
 #     "created_at": timestamp,
-#     "chunks": 5,
+#     "chunks": 2,
+#     "piece_length": 65536,        # Chosen from the size, see manifest.py
+#     "manifest": {                 # Piece hashes, see manifest.py
+#       "size": 123456, "piece_length": 65536, "pieces": "<base64>", "root": "<hex>"
+#     },
 #     "peers": {
 #       "peer_id": {
 #         "ip": "127.0.0.1",
 #         "port": 5000,
 #         "last_seen": timestamp,
-#         "chunks": [0, 1, 2]  # Chunks this peer has
+#         "seeder": False,          # True if the peer has every chunk
+#         "bitfield": b"\xe0"       # Packed bits of the chunks it has
 #       }
 #     }
 #   }
 # }
 
-# Check if the database file exists, if not create an empty one
-DB_FILE = "tracker_db.json"
-if not os.path.exists(DB_FILE):
-    with open(DB_FILE, "w") as f:
-        json.dump({}, f)
+# Tracker state lives in memory; tracker_db.json is the latest snapshot and
+# tracker_db.log holds the changes made since it was taken. Shards started
+# by tracker_router.py each get their own file through TRACKER_DB.
+DB_FILE = os.environ.get("TRACKER_DB", "tracker_db.json")
+store = TrackerStore(DB_FILE)
+atexit.register(store.close)
 
-def load_db():
-    with open(DB_FILE, "r") as f:
-        return json.load(f)
+# Behind tracker_router.py every request comes from the router, which
+# passes the announcing peer's address in X-Forwarded-For
+TRUST_PROXY = os.environ.get("TRACKER_TRUST_PROXY") == "1"
 
-def save_db(db):
-    with open(DB_FILE, "w") as f:
-        json.dump(db, f, indent=2)
+def peer_address():
+    """IP address of the peer making the current request"""
+    if TRUST_PROXY and 'X-Forwarded-For' in request.headers:
+        return request.headers['X-Forwarded-For'].split(',')[0].strip()
+    return request.remote_addr
 
 @app.route('/announce', methods=['POST'])
 def announce():
     """
     Endpoint for peers to announce their presence and update their status
     """
-    data = request.json
-    peer_id = data.get('peer_id')
-    file_id = data.get('file_id')
-    ip = request.remote_addr
-    port = data.get('port')
-    chunks = data.get('chunks', [])
-    
-    if not peer_id or not file_id or not port:
-        return jsonify({"error": "Missing required fields"}), 400
-    
-    db = load_db()
-    
-    # Initialize file entry if it doesn't exist
-    if file_id not in db and 'filename' in data and 'size' in data and 'chunks' in data:
-        db[file_id] = {
-            "filename": data['filename'],
-            "size": data['size'],
-            "created_at": time.time(),
-            "chunks": data['chunks'],
-            "peers": {}
-        }
-    elif file_id not in db:
-        return jsonify({"error": "File not found and insufficient information to create"}), 404
-    
-    # Update peer information
-    if peer_id not in db[file_id]["peers"]:
-        db[file_id]["peers"][peer_id] = {}
-    
-    db[file_id]["peers"][peer_id] = {
-        "ip": ip,
-        "port": port,
-        "last_seen": time.time(),
-        "chunks": chunks
-    }
-    
-    save_db(db)
-    
-    # Return list of peers that have this file
-    peers_with_file = {}
-    for pid, peer_info in db[file_id]["peers"].items():
-        # Don't include the requesting peer in the response
-        if pid != peer_id:
-            # Filter out peers that haven't been seen in the last 5 minutes
-            if time.time() - peer_info["last_seen"] < 300:
-                peers_with_file[pid] = {
-                    "ip": peer_info["ip"],
-                    "port": peer_info["port"],
-                    "chunks": peer_info["chunks"]
-                }
-    
-    return jsonify({
-        "file_id": file_id,
-        "peers": peers_with_file,
-        "total_chunks": db[file_id]["chunks"]
-    })
+    payload, status = tracker_api.announce(store, request.json, peer_address())
+    return jsonify(payload), status
+
+@app.route('/announce/batch', methods=['POST'])
+def announce_batch():
+    """
+    Announce many files in one request
+    """
+    payload, status = tracker_api.announce_batch(store, request.json, peer_address())
+    return jsonify(payload), status
 
 @app.route('/list', methods=['GET'])
 def list_files():
     """
     List all available files in the tracker
     """
-    db = load_db()
-    files = {}
-    
-    for file_id, file_info in db.items():
-        # Count active peers (seen in the last 5 minutes)
-        active_peers = 0
-        for peer_info in file_info["peers"].values():
-            if time.time() - peer_info["last_seen"] < 300:
-                active_peers += 1
-        
-        files[file_id] = {
-            "filename": file_info["filename"],
-            "size": file_info["size"],
-            "chunks": file_info["chunks"],
-            "active_peers": active_peers
-        }
-    
-    return jsonify({"files": files})
+    payload, status = tracker_api.list_files(store)
+    return jsonify(payload), status
 
 @app.route('/file/<file_id>', methods=['GET'])
 def get_file_info(file_id):
     """
-    Get detailed information about a specific file
+    Get detailed information about a specific file. Pass ?compact=1 to
+    get peer availability as bitfields instead of chunk lists, and
+    ?numwant=N to get a sample of at most N peers instead of all of them.
     """
-    db = load_db()
-    
-    if file_id not in db:
-        return jsonify({"error": "File not found"}), 404
-    
-    file_info = db[file_id]
-    active_peers = {}
-    
-    for peer_id, peer_info in file_info["peers"].items():
-        if time.time() - peer_info["last_seen"] < 300:
-            active_peers[peer_id] = {
-                "ip": peer_info["ip"],
-                "port": peer_info["port"],
-                "chunks": peer_info["chunks"]
-            }
-    
-    return jsonify({
-        "file_id": file_id,
-        "filename": file_info["filename"],
-        "size": file_info["size"],
-        "chunks": file_info["chunks"],
-        "peers": active_peers
-    })
+    payload, status = tracker_api.get_file_info(
+        store,
+        file_id,
+        compact=tracker_api.is_flag_set(request.args.get('compact')),
+        numwant=request.args.get('numwant', type=int)
+    )
+    return jsonify(payload), status
+
+@app.route('/file/<file_id>/availability', methods=['GET'])
+def get_file_availability(file_id):
+    """
+    Get how many live peers hold each chunk of a file
+    """
+    payload, status = tracker_api.get_file_availability(
+        store,
+        file_id,
+        compact=tracker_api.is_flag_set(request.args.get('compact'))
+    )
+    return jsonify(payload), status
+
+@app.route('/file/<file_id>/manifest', methods=['GET'])
+def get_file_manifest(file_id):
+    """
+    Get the piece-hash manifest of a file
+    """
+    payload, status = tracker_api.get_file_manifest(store, file_id)
+    return jsonify(payload), status
 
 @app.route('/generate_file_id', methods=['POST'])
 def generate_file_id():
     """
-    Generate a unique file ID based on file properties
+    Derive a content-addressed file ID from a file's piece hashes
     """
-    data = request.json
-    filename = data.get('filename')
-    size = data.get('size')
-    
-    if not filename or not size:
-        return jsonify({"error": "Missing required fields"}), 400
-    
-    # Create a unique file ID by hashing filename and size
-    # In a real implementation, this would include file hash too
-    unique_string = f"{filename}-{size}-{time.time()}"
-    file_id = hashlib.sha256(unique_string.encode()).hexdigest()[:16]
-    
-    return jsonify({"file_id": file_id})
+    payload, status = tracker_api.generate_file_id(request.json)
+    return jsonify(payload), status
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Mini-Torrent tracker')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='Port to listen on')
+    args = parser.parse_args()
+    
+    # The reloader would start a second process writing to the same log
+    app.run(host=args.host, port=args.port, debug=True, use_reloader=False)
\ No newline at end of file
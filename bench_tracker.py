@@ -0,0 +1,340 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+import bitfield
+
+# Load generator for the tracker. Simulates a population of virtual peers
+# spread over a number of swarms and drives /announce, /list and
+# /file/<id> against a tracker, then reports throughput, latency
+# percentiles and the tracker's memory footprint.
+#
+#   python bench_tracker.py --peers 5000 --files 50 --chunks 1000 --duration 30
+#   python bench_tracker.py --server asgi --rate 2000 --mix announce=90,file=10
+#   python bench_tracker.py --tracker http://host:5000 --tracker-pid 1234
+#
+# Without --tracker a fresh tracker (app.py, tracker_asgi.py or
+# tracker_router.py) is started on a scratch database for the run.
+
+SERVERS = {
+    "flask": ["app.py"],
+    "asgi": ["tracker_asgi.py", "--backlog", "4096"],
+    "sharded": ["tracker_router.py", "--spawn", "4"],
+}
+
+
+class VirtualPeer:
+    """One simulated peer in one swarm"""
+
+    def __init__(self, file_id, num_chunks, port, seeder):
+        self.peer_id = uuid.uuid4().hex[:8]
+        self.file_id = file_id
+        self.num_chunks = num_chunks
+        self.port = port
+        self.seeder = seeder
+        self.bits = bitfield.full(num_chunks) if seeder else bitfield.empty(num_chunks)
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def announce_body(self, delta_ratio, numwant):
+        """Build the next announce: a "have" delta or a full bitfield"""
+        with self.lock:
+            missing = [] if self.seeder else [
+                i for i in random.sample(range(self.num_chunks), min(8, self.num_chunks))
+                if not bitfield.has(self.bits, i)
+            ]
+            body = {
+                "peer_id": self.peer_id, "file_id": self.file_id, "port": self.port,
+                "numwant": numwant, "compact": True
+            }
+            self.seq += 1
+            body["seq"] = self.seq
+            if self.seq > 1 and missing and random.random() < delta_ratio:
+                new = missing[:1]
+                for index in new:
+                    bitfield.set_bit(self.bits, index)
+                body["have"] = new
+            elif self.seeder:
+                body["seeder"] = True
+            else:
+                for index in missing[:1]:
+                    bitfield.set_bit(self.bits, index)
+                body["bitfield"] = bitfield.encode(self.bits)
+            return body
+
+    def resync(self):
+        """The tracker lost our sequence; the next announce will be a full one"""
+        with self.lock:
+            self.seq = 0
+
+
+class Recorder:
+    """Collects per-operation latencies and error counts from all workers"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, op, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(op, []).append(seconds)
+            if not ok:
+                self.errors[op] = self.errors.get(op, 0) + 1
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def parse_mix(text):
+    """Turn "announce=80,list=5,file=15" into cumulative weights"""
+    weights = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        if op not in ("announce", "list", "file"):
+            raise argparse.ArgumentTypeError(f"Unknown operation in mix: {op}")
+        weights[op] = float(weight)
+    total = sum(weights.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError("Mix weights must add up to more than 0")
+    return {op: weight / total for op, weight in weights.items()}
+
+
+def request(conn, method, path, body=None):
+    """Send one request on a keep-alive connection, return (status, parsed body)"""
+    payload = None if body is None else json.dumps(body)
+    headers = {"Content-Type": "application/json"} if payload else {}
+    conn.request(method, path, body=payload, headers=headers)
+    response = conn.getresponse()
+    data = response.read()
+    return response.status, (json.loads(data) if data else None)
+
+
+def rss_kb(pid):
+    """Resident set size of a process and its children in KB (Linux /proc)"""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total or None
+
+
+def worker(base_url, peers, file_ids, mix, args, recorder, deadline, interval):
+    """Issue requests until the deadline, optionally paced to one per ``interval``"""
+    parts = urlsplit(base_url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+    ops = list(mix.items())
+    next_send = time.perf_counter()
+
+    while time.perf_counter() < deadline:
+        if interval:
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_send += interval
+
+        roll = random.random()
+        op = ops[-1][0]
+        for name, weight in ops:
+            if roll < weight:
+                op = name
+                break
+            roll -= weight
+
+        start = time.perf_counter()
+        try:
+            if op == "announce":
+                peer = random.choice(peers)
+                body = peer.announce_body(args.delta_ratio, args.numwant)
+                status, data = request(conn, "POST", "/announce", body)
+                if status == 409:
+                    peer.resync()
+            elif op == "list":
+                status, data = request(conn, "GET", "/list")
+            else:
+                path = f"/file/{random.choice(file_ids)}?compact=1&numwant={args.numwant}"
+                status, data = request(conn, "GET", path)
+            ok = status in (200, 409)
+        except (OSError, http.client.HTTPException, ValueError):
+            ok = False
+            conn.close()
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        recorder.add(op, time.perf_counter() - start, ok)
+
+    conn.close()
+
+
+def start_tracker(kind, port, workdir):
+    """Start a local tracker on a scratch database and wait until it answers"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    script, *extra = SERVERS[kind]
+    command = [sys.executable, os.path.join(here, script), "--port", str(port)] + extra
+    if kind == "sharded":
+        command += ["--base-port", str(port + 1)]
+    env = dict(os.environ, TRACKER_DB=os.path.join(workdir, "tracker_db.json"))
+    if kind == "asgi":
+        command += ["--db", env["TRACKER_DB"]]
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 30
+    while True:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            request(conn, "GET", "/list")
+            conn.close()
+            return process
+        except (OSError, http.client.HTTPException):
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                raise RuntimeError(f"Tracker ({kind}) did not start")
+            time.sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mini-Torrent tracker load generator')
+    parser.add_argument('--tracker', type=str, default=None, help='URL of a running tracker (default: start one)')
+    parser.add_argument('--tracker-pid', type=int, default=None, help='PID of that tracker, to report its memory')
+    parser.add_argument('--server', choices=sorted(SERVERS), default='flask',
+                        help='Tracker to start when --tracker is not given')
+    parser.add_argument('--port', type=int, default=5090, help='Port for the tracker started by the benchmark')
+    parser.add_argument('--files', type=int, default=20, help='Number of swarms')
+    parser.add_argument('--peers', type=int, default=2000, help='Virtual peers, spread evenly over the swarms')
+    parser.add_argument('--chunks', type=int, default=1000, help='Chunks per file')
+    parser.add_argument('--seeders', type=float, default=0.2, help='Fraction of virtual peers that are seeders')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of measured load')
+    parser.add_argument('--concurrency', type=int, default=32, help='Concurrent connections')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Target requests per second across all connections (0 = as fast as possible)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix("announce=80,list=5,file=15"),
+                        help='Relative weights of announce, list and file requests')
+    parser.add_argument('--delta-ratio', type=float, default=0.8,
+                        help='Fraction of re-announces sent as "have" deltas')
+    parser.add_argument('--numwant', type=int, default=50, help='Peers asked for per announce')
+    parser.add_argument('--json', type=str, default=None, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_tracker_")
+    process = None
+    try:
+        if args.tracker:
+            base_url = args.tracker.rstrip('/')
+            tracker_pid = args.tracker_pid
+        else:
+            process = start_tracker(args.server, args.port, workdir)
+            base_url = f"http://127.0.0.1:{args.port}"
+            tracker_pid = process.pid
+
+        # Register the swarms and let every virtual peer announce once so
+        # the tracker holds a realistic amount of state before measuring
+        parts = urlsplit(base_url)
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        file_ids = [uuid.uuid4().hex[:16] for _ in range(args.files)]
+        for file_id in file_ids:
+            request(conn, "POST", "/announce", {
+                "peer_id": uuid.uuid4().hex[:8], "file_id": file_id, "port": 6000,
+                "filename": f"{file_id}.bin", "size": args.chunks * 1024 * 1024,
+                "num_chunks": args.chunks, "seeder": True, "numwant": 0
+            })
+        peers = [
+            VirtualPeer(file_ids[i % args.files], args.chunks, 6001 + i % 50000, random.random() < args.seeders)
+            for i in range(args.peers)
+        ]
+        print(f"Warming up: {args.peers} peers in {args.files} swarms of {args.chunks} chunks...")
+        warmup_start = time.perf_counter()
+        for peer in peers:
+            body = peer.announce_body(0, 0)
+            request(conn, "POST", "/announce", body)
+        warmup = time.perf_counter() - warmup_start
+        conn.close()
+        memory_before = rss_kb(tracker_pid) if tracker_pid else None
+
+        recorder = Recorder()
+        interval = args.concurrency / args.rate if args.rate else 0
+        deadline = time.perf_counter() + args.duration
+        threads = [
+            threading.Thread(
+                target=worker,
+                args=(base_url, peers, file_ids, args.mix, args, recorder, deadline, interval),
+                daemon=True
+            )
+            for _ in range(args.concurrency)
+        ]
+        print(f"Running for {args.duration:.0f}s with {args.concurrency} connections...")
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        memory_after = rss_kb(tracker_pid) if tracker_pid else None
+
+        results = {
+            "config": {key: value for key, value in vars(args).items() if key != "json"},
+            "warmup_announces_per_sec": args.peers / warmup if warmup else None,
+            "elapsed": elapsed,
+            "tracker_rss_kb": {"after_warmup": memory_before, "after_run": memory_after},
+            "operations": {}
+        }
+        total = 0
+        print()
+        print(f"{'op':<10} {'count':>8} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        print("-" * 64)
+        for op, values in sorted(recorder.latencies.items()):
+            values.sort()
+            total += len(values)
+            stats = {
+                "count": len(values),
+                "errors": recorder.errors.get(op, 0),
+                "throughput": len(values) / elapsed,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000
+            }
+            results["operations"][op] = stats
+            print(f"{op:<10} {stats['count']:>8} {stats['errors']:>7} {stats['throughput']:>9.1f} "
+                  f"{stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f}")
+        results["throughput"] = total / elapsed
+        print("-" * 64)
+        print(f"Total throughput: {results['throughput']:.1f} req/s")
+        if memory_after:
+            print(f"Tracker memory: {memory_before / 1024:.1f} MB after warm-up, "
+                  f"{memory_after / 1024:.1f} MB after run")
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import base64
+
+# Chunk availability is exchanged as a packed bitfield: one bit per chunk,
+# most significant bit first, padded with zero bits to a whole byte, and
+# base64-encoded when it travels inside JSON. A 50k-chunk file fits in
+# about 8 KB instead of a list of 50k integers.
+
+
+def size_for(num_chunks):
+    """Number of bytes needed to hold one bit per chunk"""
+    return (num_chunks + 7) // 8
+
+
+def empty(num_chunks):
+    """A bitfield with no chunks set"""
+    return bytearray(size_for(num_chunks))
+
+
+def full(num_chunks):
+    """A bitfield with every chunk set"""
+    bits = bytearray(b"\xff" * size_for(num_chunks))
+    spare = size_for(num_chunks) * 8 - num_chunks
+    if spare:
+        bits[-1] = (0xff << spare) & 0xff
+    return bits
+
+
+def set_bit(bits, index):
+    """Mark a chunk as present in a bytearray bitfield"""
+    bits[index >> 3] |= 0x80 >> (index & 7)
+
+
+def has(bits, index):
+    """Check whether a chunk is present"""
+    byte = index >> 3
+    return byte < len(bits) and bool(bits[byte] & (0x80 >> (index & 7)))
+
+
+def from_indices(indices, num_chunks):
+    """Build a bitfield from a list of chunk indices"""
+    bits = empty(num_chunks)
+    for index in indices:
+        if 0 <= index < num_chunks:
+            set_bit(bits, index)
+    return bits
+
+
+def iter_set(bits):
+    """Yield the indices of the chunks set in a bitfield, skipping empty bytes"""
+    for byte_index, byte in enumerate(bits):
+        if byte:
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    yield byte_index * 8 + bit
+
+
+def to_indices(bits, num_chunks):
+    """List the chunk indices set in a bitfield"""
+    return [i for i in iter_set(bits) if i < num_chunks]
+
+
+def difference(a, b):
+    """Bitfield of the chunks set in ``a`` but not in ``b`` (same length)"""
+    return (int.from_bytes(a, "big") & ~int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+
+def count(bits):
+    """Number of chunks set"""
+    return int.from_bytes(bits, "big").bit_count()
+
+
+def is_complete(bits, num_chunks):
+    """True when every chunk is set"""
+    return count(bits) == num_chunks
+
+
+def encode(bits):
+    """Encode a bitfield for a JSON payload"""
+    return base64.b64encode(bytes(bits)).decode("ascii")
+
+
+def decode(text, num_chunks=None):
+    """
+    Decode a base64 bitfield. When ``num_chunks`` is given the length is
+    checked and any padding bits past the last chunk are cleared.
+    """
+    bits = bytearray(base64.b64decode(text, validate=True))
+    if num_chunks is not None:
+        if len(bits) != size_for(num_chunks):
+            raise ValueError(f"Bitfield is {len(bits)} bytes, expected {size_for(num_chunks)}")
+        spare = len(bits) * 8 - num_chunks
+        if spare:
+            bits[-1] &= (0xff << spare) & 0xff
+    return bits
+
+
+def peer_has(peer_info, index):
+    """Check a tracker peer entry (seeder flag or decoded bitfield) for a chunk"""
+    return peer_info.get("seeder", False) or has(peer_info.get("bitfield", b""), index)
+
+
+def decode_peers(peers):
+    """Unpack the base64 bitfields of a compact tracker peer list in place"""
+    for peer_info in peers.values():
+        if isinstance(peer_info.get("bitfield"), str):
+            peer_info["bitfield"] = decode(peer_info["bitfield"])
+    return peers
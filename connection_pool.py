@@ -0,0 +1,113 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Keep-alive HTTP connections for a peer client. Every remote peer (keyed
+# by its ip:port) and the tracker get their own requests.Session, so a
+# chunk fetch reuses an open TCP connection instead of handshaking anew.
+# Sessions nobody used for IDLE_TIMEOUT seconds are closed, and stats()
+# reports how many requests went over how many connections.
+
+# Connections kept open to one remote host; matches the download engine's
+# per-peer request limit, with room for endgame duplicates
+POOL_SIZE = 12
+# Seconds a session may sit unused before its connections are closed
+IDLE_TIMEOUT = 60
+# Retries for requests that fail to connect, or (for GET only) fail while
+# reading the response; POSTs are never resent once they went out
+RETRIES = 2
+# Base of the exponential backoff between retries, in seconds
+BACKOFF = 0.2
+
+TRACKER = "tracker"
+
+
+class ConnectionPools:
+    """One pooled keep-alive session per remote host"""
+
+    def __init__(self, pool_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT, retries=RETRIES):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.lock = threading.Lock()
+        # key -> {"session", "last_used", "created_at"}
+        self.pools = {}
+        self.last_eviction = time.time()
+        self.evicted = 0
+
+    def _new_session(self):
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=0,
+            backoff_factor=BACKOFF,
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry, pool_block=False)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def session(self, key):
+        """The session for a remote host, e.g. "10.0.0.5:8001" or TRACKER"""
+        with self.lock:
+            now = time.time()
+            if now - self.last_eviction >= self.idle_timeout / 2:
+                self._evict_idle(now)
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = self.pools[key] = {"session": self._new_session(), "last_used": now, "created_at": now}
+            pool["last_used"] = now
+            return pool["session"]
+
+    def tracker(self):
+        """The session for tracker requests"""
+        return self.session(TRACKER)
+
+    def peer(self, peer_info):
+        """The session for a peer entry from the tracker"""
+        return self.session(f"{peer_info['ip']}:{peer_info['port']}")
+
+    def _evict_idle(self, now):
+        self.last_eviction = now
+        for key in [k for k, pool in self.pools.items() if now - pool["last_used"] > self.idle_timeout]:
+            self.pools.pop(key)["session"].close()
+            self.evicted += 1
+
+    def evict_idle(self):
+        """Close sessions that have been idle for longer than the timeout"""
+        with self.lock:
+            self._evict_idle(time.time())
+
+    def stats(self):
+        """Requests and connections per host; reuse is the share of requests that didn't open a connection"""
+        with self.lock:
+            now = time.time()
+            hosts = {}
+            for key, pool in self.pools.items():
+                requests_made = connections = 0
+                for adapter in set(pool["session"].adapters.values()):
+                    manager = adapter.poolmanager
+                    for connection_pool in [manager.pools[pool_key] for pool_key in manager.pools.keys()]:
+                        requests_made += connection_pool.num_requests
+                        connections += connection_pool.num_connections
+                hosts[key] = {
+                    "requests": requests_made,
+                    "connections": connections,
+                    "reuse": 1 - connections / requests_made if requests_made else 0.0,
+                    "idle_seconds": now - pool["last_used"]
+                }
+            return {"hosts": hosts, "open_pools": len(self.pools), "evicted": self.evicted}
+
+    def close(self):
+        """Close every session"""
+        with self.lock:
+            for pool in self.pools.values():
+                pool["session"].close()
+            self.pools.clear()
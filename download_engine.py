@@ -0,0 +1,424 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bitfield
+import peer_scoring
+import piece_picker
+
+# Concurrent chunk downloader. Chunks are fetched in BLOCK_SIZE blocks
+# (byte ranges of a chunk), and the blocks of one chunk are spread over
+# every peer that has it, so a slow peer holds up one block rather than a
+# whole chunk. Up to MAX_WORKERS block requests are in flight for a
+# download, with at most PER_PEER_LIMIT outstanding on any one peer so
+# each peer always has its next request queued (pipelining) without one
+# peer taking all the work. Blocks land in a buffer preallocated for their
+# chunk; started chunks are finished before new ones are begun, so only a
+# few chunk buffers exist at a time. Which chunks go first is up to a
+# piece picker (see piece_picker.py).
+#
+# With a PeerScores (see peer_scoring.py) each block goes to the peer
+# expected to deliver it soonest. Peers that choke us are left alone
+# until they say to come back.
+#
+# With a ``verify_chunk`` check every complete chunk is verified on a
+# separate hashing pool before it is stored, so network workers go
+# straight back to fetching. A chunk that fails is requested again. If
+# its blocks came from one peer, that peer is blamed, and a peer that
+# sends peer_scoring.MAX_CORRUPT_CHUNKS bad chunks is banned. If they came from
+# several, the chunk is fetched again whole from a single peer, so the
+# next failure has a culprit.
+#
+# Once every missing block has been requested (endgame), each block still
+# in flight is also requested from other peers, up to ENDGAME_REQUESTS at
+# once; the first copy to arrive is kept and the other requests are
+# cancelled, so one slow peer can't hold up the end of a download.
+#
+# The engine knows nothing about HTTP or files: the peer client passes in
+# how to fetch, store and look up peers.
+
+logger = logging.getLogger("DownloadEngine")
+
+# Block requests in flight at once for one download
+MAX_WORKERS = 32
+# Requests in flight at once to a single peer
+PER_PEER_LIMIT = 8
+# Bytes per block request
+BLOCK_SIZE = 64 * 1024
+# Failed requests in a row after which a peer is left alone until the
+# next peer list refresh
+MAX_PEER_FAILURES = 3
+# Seconds between peer list refreshes while downloading
+PEER_REFRESH_INTERVAL = 30
+# Seconds to wait before asking for peers again when nobody has what we need
+RETRY_DELAY = 5
+# Peers asked for the same block at once in endgame mode
+ENDGAME_REQUESTS = 3
+# Threads verifying chunk hashes
+HASH_WORKERS = os.cpu_count() or 1
+
+
+class PeerChoked(Exception):
+    """Raised by ``fetch_block`` when a peer has no upload slot for us right now"""
+
+    def __init__(self, retry_after=RETRY_DELAY):
+        super().__init__(f"Choked, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class DownloadEngine:
+    """
+    Download the missing chunks of one file from a set of peers.
+
+    ``fetch_block(peer_info, index, begin, length, cancelled)`` returns
+    ``length`` bytes of chunk ``index`` starting at offset ``begin``, or
+    raises (PeerChoked when the peer won't serve us for now), and should
+    give up early once the ``cancelled`` event is set;
+    ``store_chunk(index, data)`` saves a fetched chunk; ``refresh_peers()``
+    returns a fresh ``{peer_id: peer_info}`` dict from the tracker (or None
+    if it couldn't get one); ``chunk_size(index)`` is the length of a
+    chunk. ``is_active()`` is polled so a download can be cancelled. Peer
+    entries use the tracker's compact form, see bitfield.peer_has.
+
+    ``picker`` orders the chunks (rarest first by default), and the
+    optional ``fetch_availability()`` returns swarm-wide replica counts per
+    chunk to rank them by. ``scores`` is a peer_scoring.PeerScores that
+    is fed with every request and used to prefer fast peers, and
+    ``verify_chunk(index, data)`` returns False for chunks whose hash is
+    wrong.
+    """
+
+    def __init__(self, total_chunks, peers, fetch_block, store_chunk, refresh_peers, chunk_size,
+                 have=(), is_active=None, picker=None, fetch_availability=None, scores=None,
+                 verify_chunk=None, max_workers=MAX_WORKERS, per_peer_limit=PER_PEER_LIMIT,
+                 block_size=BLOCK_SIZE):
+        self.total_chunks = total_chunks
+        self.peers = dict(peers)
+        self.fetch_block = fetch_block
+        self.store_chunk = store_chunk
+        self.refresh_peers = refresh_peers
+        self.chunk_size = chunk_size
+        self.fetch_availability = fetch_availability
+        self.scores = scores
+        self.verify_chunk = verify_chunk
+        self.is_active = is_active or (lambda: True)
+        self.max_workers = max_workers
+        self.per_peer_limit = per_peer_limit
+        self.block_size = block_size
+
+        have = set(have)
+        # Chunks not started yet, as an ordered set; failed chunks go to the back
+        self.pending = dict.fromkeys(i for i in range(total_chunks) if i not in have)
+        # Started chunks, oldest first: chunk index -> {"buffer", "block_size",
+        # "blocks" (ordered set of the offsets still to request), "in_flight"
+        # (offset -> {peer_id: cancel event}), "sources" (peers that sent blocks)}
+        self.partial = {}
+        # Chunks to fetch whole from one peer, after a bad copy pieced together from several
+        self.single_source = set()
+        # Requests in flight, counting endgame duplicates
+        self.requests = 0
+        # Chunks fetched and being stored
+        self.storing = 0
+        # peer_id -> requests in flight to it
+        self.peer_load = {}
+        # peer_id -> failed requests in a row
+        self.failures = {}
+        # peer_id -> time until which it has us choked
+        self.choked_until = {}
+        # peer_id -> bad chunks it sent us
+        self.corrupt = {}
+        # chunk index -> peers that sent a bad copy of it
+        self.bad_sources = {}
+        # Set once run() is done; late blocks and chunks are dropped from then on
+        self.closed = False
+        self.cond = threading.Condition()
+
+        self.picker = picker or piece_picker.create(piece_picker.DEFAULT_STRATEGY, total_chunks, have)
+        self.picker.update(self.peers)
+
+    def run(self):
+        """Download until every chunk is stored or the download is cancelled; True when complete"""
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS)
+        last_refresh = time.time()
+        if self.fetch_availability:
+            self._update_picker(self.peers, self.fetch_availability())
+        try:
+            with self.cond:
+                while self.pending or self.partial or self.storing:
+                    if not self.is_active():
+                        self._cancel_all()
+                        return False
+
+                    self._assign(pool)
+
+                    stalled = not self.requests and not self.storing and (self.pending or self.partial)
+                    if stalled or time.time() - last_refresh >= PEER_REFRESH_INTERVAL:
+                        if stalled:
+                            missing = len(self.pending) + len(self.partial)
+                            logger.info(f"No peer has the {missing} missing chunks, retrying in {RETRY_DELAY}s")
+                            self.cond.wait(RETRY_DELAY)
+                        self.cond.release()
+                        try:
+                            peers = self.refresh_peers()
+                            counts = self.fetch_availability() if self.fetch_availability else None
+                        finally:
+                            self.cond.acquire()
+                        last_refresh = time.time()
+                        if peers is not None:
+                            self._merge_peers(peers)
+                        self._update_picker(self.peers, counts)
+                        continue
+
+                    self.cond.wait(1)
+            return True
+        finally:
+            with self.cond:
+                self.closed = True
+            # Requests were cancelled; once the workers are gone nothing
+            # can be stored any more, so the caller may close the file
+            pool.shutdown(wait=True, cancel_futures=True)
+            self.hash_pool.shutdown(wait=True, cancel_futures=True)
+
+    def _cancel_all(self):
+        for piece in self.partial.values():
+            for requests in piece["in_flight"].values():
+                for cancelled in requests.values():
+                    cancelled.set()
+
+    def _merge_peers(self, peers):
+        """Take a fresh peer list; peers we gave up on get another chance"""
+        self.peers = dict(peers)
+        for peer_id in list(self.failures):
+            if self.failures[peer_id] >= MAX_PEER_FAILURES:
+                del self.failures[peer_id]
+
+    def _update_picker(self, peers, counts):
+        with self.cond:
+            self.picker.update(peers, counts)
+
+    def _usable_peers(self):
+        now = time.time()
+        return [
+            (peer_id, peer_info) for peer_id, peer_info in self.peers.items()
+            if self.failures.get(peer_id, 0) < MAX_PEER_FAILURES
+            and self.choked_until.get(peer_id, 0) <= now
+            and not self.is_banned(peer_id)
+        ]
+
+    def is_banned(self, peer_id):
+        """Whether a peer sent too many bad chunks, here or (with scores) in another download"""
+        if self.corrupt.get(peer_id, 0) >= peer_scoring.MAX_CORRUPT_CHUNKS:
+            return True
+        return self.scores is not None and self.scores.is_banned(peer_id)
+
+    def _expected_rate(self, peer_id):
+        """Share of a peer's throughput a new request would get"""
+        load = self.peer_load.get(peer_id, 0)
+        if self.scores is None:
+            return -load
+        return self.scores.score(peer_id) / (load + 1)
+
+    def _assign(self, pool):
+        """
+        Hand blocks to idle capacity, each to the best peer that has its
+        chunk: first the rest of the started chunks, then new chunks in the
+        picker's order, then endgame duplicates
+        """
+        open_peers = {
+            peer_id: peer_info for peer_id, peer_info in self._usable_peers()
+            if self.peer_load.get(peer_id, 0) < self.per_peer_limit
+        }
+        for index in list(self.partial):
+            if not self._request_blocks(pool, index, open_peers):
+                return
+        for index in self.picker.order(self.pending):
+            if self.requests >= self.max_workers or not open_peers:
+                return
+            if any(bitfield.peer_has(peer_info, index) for peer_info in open_peers.values()):
+                del self.pending[index]
+                self._start(index)
+                self._request_blocks(pool, index, open_peers)
+
+        if not self.pending and not any(piece["blocks"] for piece in self.partial.values()):
+            for index, piece in self.partial.items():
+                for begin in list(piece["in_flight"]):
+                    requests = piece["in_flight"][begin]
+                    while len(requests) < ENDGAME_REQUESTS and self.requests < self.max_workers:
+                        if not self._request(pool, index, begin, open_peers):
+                            break
+
+    def _start(self, index):
+        """Set up the buffer and block list of a chunk about to be requested"""
+        size = self.chunk_size(index)
+        # Retried chunks that must come from one peer are a single block
+        block_size = size if index in self.single_source else self.block_size
+        self.partial[index] = {
+            "buffer": bytearray(size),
+            "block_size": block_size,
+            "blocks": dict.fromkeys(range(0, size, block_size)),
+            "in_flight": {},
+            "sources": set()
+        }
+
+    def _request_blocks(self, pool, index, open_peers):
+        """Request the unrequested blocks of a started chunk; False once there is no capacity left"""
+        blocks = self.partial[index]["blocks"]
+        for begin in list(blocks):
+            if self.requests >= self.max_workers or not open_peers:
+                return False
+            if not self._request(pool, index, begin, open_peers):
+                # No open peer has this chunk
+                break
+            del blocks[begin]
+        return True
+
+    def _request(self, pool, index, begin, open_peers):
+        """Request a block from the best open peer that has its chunk and isn't already asked; False if none"""
+        piece = self.partial[index]
+        requests = piece["in_flight"].setdefault(begin, {})
+        candidates = [
+            peer_id for peer_id, peer_info in open_peers.items()
+            if peer_id not in requests and bitfield.peer_has(peer_info, index)
+        ]
+        # After a bad copy, ask someone else if there is anyone else
+        bad_sources = self.bad_sources.get(index)
+        if bad_sources:
+            candidates = [peer_id for peer_id in candidates if peer_id not in bad_sources] or candidates
+        if not candidates:
+            if not requests:
+                del piece["in_flight"][begin]
+            return False
+        peer_id = max(candidates, key=self._expected_rate)
+        peer_info = open_peers[peer_id]
+
+        cancelled = threading.Event()
+        requests[peer_id] = cancelled
+        self.requests += 1
+        self.peer_load[peer_id] = self.peer_load.get(peer_id, 0) + 1
+        if self.peer_load[peer_id] >= self.per_peer_limit:
+            del open_peers[peer_id]
+        length = min(piece["block_size"], len(piece["buffer"]) - begin)
+        pool.submit(self._fetch, index, begin, length, peer_id, peer_info, cancelled)
+        return True
+
+    def _fetch(self, index, begin, length, peer_id, peer_info, cancelled):
+        """
+        Worker: fetch one block, copy it into its chunk's buffer if it's the
+        first copy, and report back to the scheduler
+        """
+        data = None
+        choked = False
+        started = time.time()
+        try:
+            data = self.fetch_block(peer_info, index, begin, length, cancelled)
+            if len(data) != length:
+                raise IOError(f"Got {len(data)} bytes, expected {length}")
+            if self.scores is not None:
+                self.scores.record_success(peer_id, length, time.time() - started)
+        except PeerChoked as e:
+            data = None
+            choked = True
+            with self.cond:
+                self.choked_until[peer_id] = time.time() + e.retry_after
+        except Exception as e:
+            data = None
+            if not cancelled.is_set():
+                logger.warning(f"Failed to download chunk {index} at {begin} from peer {peer_id}: {e}")
+                if self.scores is not None:
+                    self.scores.record_failure(peer_id)
+
+        complete = None
+        with self.cond:
+            self.requests -= 1
+            self.peer_load[peer_id] -= 1
+            piece = self.partial.get(index)
+            requests = piece["in_flight"].get(begin) if piece is not None else None
+            current = not self.closed and requests is not None and requests.get(peer_id) is cancelled
+            if data is not None and current:
+                # Cancel the duplicate requests of endgame mode
+                del piece["in_flight"][begin]
+                for other, other_cancelled in requests.items():
+                    if other != peer_id:
+                        other_cancelled.set()
+                piece["buffer"][begin:begin + length] = data
+                piece["sources"].add(peer_id)
+                self.failures[peer_id] = 0
+                if not piece["blocks"] and not piece["in_flight"]:
+                    complete = self.partial.pop(index)
+                    self.storing += 1
+            elif current:
+                del requests[peer_id]
+                if not cancelled.is_set() and not choked:
+                    self.failures[peer_id] = self.failures.get(peer_id, 0) + 1
+                if not requests:
+                    # Back to the front of the chunk's queue
+                    del piece["in_flight"][begin]
+                    piece["blocks"] = {begin: None, **piece["blocks"]}
+            self.cond.notify()
+
+        if complete is not None:
+            if self.verify_chunk is None:
+                self._store(index, complete["buffer"])
+            else:
+                self.hash_pool.submit(self._verify_and_store, index, complete["sources"], complete["buffer"])
+
+    def _verify_and_store(self, index, sources, data):
+        """Hashing worker: check a chunk against its expected hash before storing it"""
+        if self._dropped():
+            return
+        try:
+            valid = self.verify_chunk(index, data)
+        except Exception as e:
+            logger.error(f"Failed to verify chunk {index}: {e}")
+            valid = False
+        if valid:
+            self._store(index, data)
+            return
+
+        with self.cond:
+            self.storing -= 1
+            self.bad_sources.setdefault(index, set()).update(sources)
+            if len(sources) == 1:
+                peer_id = next(iter(sources))
+                logger.warning(f"Chunk {index} from peer {peer_id} failed hash verification")
+                if self.scores is not None:
+                    self.scores.record_corrupt(peer_id)
+                self.corrupt[peer_id] = self.corrupt.get(peer_id, 0) + 1
+                if self.is_banned(peer_id):
+                    logger.warning(f"Banning peer {peer_id} for sending corrupt data")
+            else:
+                # Can't tell whose block was bad; the next copy comes from one peer
+                logger.warning(f"Chunk {index} from peers {sorted(sources)} failed hash verification")
+                self.single_source.add(index)
+            self.pending[index] = None
+            self.cond.notify()
+
+    def _dropped(self):
+        """True (and the chunk is let go) if run() has finished and a fetched chunk must not be stored"""
+        with self.cond:
+            if self.closed:
+                self.storing -= 1
+            return self.closed
+
+    def _store(self, index, data):
+        if self._dropped():
+            return
+        try:
+            self.store_chunk(index, data)
+            stored = True
+        except Exception as e:
+            logger.error(f"Failed to store chunk {index}: {e}")
+            stored = False
+
+        with self.cond:
+            self.storing -= 1
+            if stored:
+                self.bad_sources.pop(index, None)
+                self.single_source.discard(index)
+                self.picker.completed(index)
+            else:
+                self.pending[index] = None
+            self.cond.notify()
@@ -0,0 +1,90 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Open descriptors of the files a peer serves, so a chunk request neither
+# reopens the file nor reads the whole chunk into one big bytes object:
+# the requested range is streamed in BLOCK_SIZE pieces read with os.pread
+# from the cached descriptor.
+#
+# A descriptor is reopened when its file changes. Files still being
+# downloaded are rewritten chunk by chunk, so for them (``live``) only
+# the size and inode count as a change, not the modification time.
+
+MAX_OPEN_FILES = 64
+# Size of the pieces handed to the WSGI server
+BLOCK_SIZE = 256 * 1024
+
+
+class FileCache:
+    """LRU cache of open read-only descriptors keyed by path"""
+
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        # path -> {"size", "mtime", "ino", "fd", "users", "evicted"}
+        self.files = OrderedDict()
+
+    def _acquire(self, path, live=False):
+        """
+        The cache entry of a file, opened if needed and marked in use. The
+        file is reopened when it was replaced or its size changed, or
+        unless it is ``live``, when its modification time changed.
+        """
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.files.get(path)
+            if entry is None or (entry["size"], entry["ino"]) != (stat.st_size, stat.st_ino) or \
+                    (not live and entry["mtime"] != stat.st_mtime_ns):
+                if entry is not None:
+                    self._evict(path)
+                entry = self.files[path] = {
+                    "size": stat.st_size,
+                    "mtime": stat.st_mtime_ns,
+                    "ino": stat.st_ino,
+                    "fd": os.open(path, os.O_RDONLY),
+                    "users": 0,
+                    "evicted": False
+                }
+                while len(self.files) > self.max_open:
+                    self._evict(next(iter(self.files)))
+            self.files.move_to_end(path)
+            entry["users"] += 1
+            return entry
+
+    def _release(self, entry):
+        with self.lock:
+            entry["users"] -= 1
+            if entry["evicted"] and not entry["users"]:
+                os.close(entry["fd"])
+
+    def _evict(self, path):
+        # Descriptors still being read from are closed by their last user
+        entry = self.files.pop(path)
+        entry["evicted"] = True
+        if not entry["users"]:
+            os.close(entry["fd"])
+
+    def size(self, path, live=False):
+        """Size of a file in bytes; raises OSError if it can't be opened"""
+        entry = self._acquire(path, live)
+        self._release(entry)
+        return entry["size"]
+
+    def discard(self, path):
+        """Forget a file, e.g. when it stops being shared"""
+        with self.lock:
+            if path in self.files:
+                self._evict(path)
+
+    def body(self, path, start, stop, live=False):
+        """Response body with bytes ``start:stop`` of a file"""
+        entry = self._acquire(path, live)
+        try:
+            for offset in range(start, stop, BLOCK_SIZE):
+                block = os.pread(entry["fd"], min(BLOCK_SIZE, stop - offset), offset)
+                if not block:
+                    return
+                yield block
+        finally:
+            self._release(entry)
@@ -0,0 +1,133 @@
+import base64
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# A file's manifest lists the SHA-256 of each of its pieces (chunks). The
+# root hash covers the file size, the piece length and every piece hash,
+# and the file ID is taken from the root, so the same content always gets
+# the same ID and lands in the same swarm no matter who shares it.
+#
+# In JSON the piece hashes travel as one base64 string of the
+# concatenated 32-byte digests:
+#
+#   {"size": 3145728, "piece_length": 1048576, "pieces": "...", "root": "..."}
+
+HASH_SIZE = 32
+# Hex characters of the root used as the file ID
+ID_LENGTH = 32
+
+# Piece lengths are powers of two between these bounds, picked per file
+# so that it has at most MAX_PIECES pieces: small files aren't split into
+# needlessly many requests and huge files don't get huge piece lists
+MIN_PIECE_LENGTH = 64 * 1024
+MAX_PIECE_LENGTH = 16 * 1024 * 1024
+MAX_PIECES = 2048
+# Piece length of files registered before it was chosen per file
+DEFAULT_PIECE_LENGTH = 1024 * 1024
+
+
+def hash_piece(data):
+    """SHA-256 digest of one piece"""
+    return hashlib.sha256(data).digest()
+
+
+def root_hash(size, piece_length, pieces):
+    """Root hash over the file size, the piece length and the concatenated piece digests"""
+    return hashlib.sha256(f"{size}:{piece_length}:".encode() + bytes(pieces)).hexdigest()
+
+
+def file_id(root):
+    """File ID for a root hash"""
+    return root[:ID_LENGTH]
+
+
+def piece_length_for(size):
+    """Piece length for a file of ``size`` bytes"""
+    piece_length = MIN_PIECE_LENGTH
+    while piece_length < MAX_PIECE_LENGTH and size > piece_length * MAX_PIECES:
+        piece_length *= 2
+    return piece_length
+
+
+def build(filepath, piece_length, on_piece=None, workers=None):
+    """
+    Hash a file in one streaming pass. Pieces are read in order and hashed
+    on a thread pool (hashlib releases the GIL on large buffers, so this
+    spreads over cores); at most a few pieces per worker are held in memory
+    at once. ``on_piece(index, data)`` is called for each piece as it is
+    read, so callers can do their own work in the same pass.
+    """
+    workers = workers or os.cpu_count() or 1
+    size = os.path.getsize(filepath)
+    digests = []
+    pending = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, open(filepath, 'rb') as f:
+        index = 0
+        while True:
+            data = f.read(piece_length)
+            if not data:
+                break
+            if on_piece:
+                on_piece(index, data)
+            pending.append(pool.submit(hash_piece, data))
+            if len(pending) >= workers * 2:
+                digests.append(pending.pop(0).result())
+            index += 1
+        digests += [future.result() for future in pending]
+
+    pieces = b"".join(digests)
+    return {
+        "size": size,
+        "piece_length": piece_length,
+        "pieces": pieces,
+        "root": root_hash(size, piece_length, pieces)
+    }
+
+
+def num_pieces(manifest):
+    """Number of pieces a manifest describes"""
+    return len(manifest["pieces"]) // HASH_SIZE
+
+
+def piece_hash(manifest, index):
+    """Expected digest of a piece"""
+    return manifest["pieces"][index * HASH_SIZE:(index + 1) * HASH_SIZE]
+
+
+def verify_piece(manifest, index, data):
+    """Check a piece's data against the manifest"""
+    return hash_piece(data) == piece_hash(manifest, index)
+
+
+def to_json(manifest):
+    """Manifest in its JSON form"""
+    return dict(manifest, pieces=base64.b64encode(manifest["pieces"]).decode("ascii"))
+
+
+def from_json(data):
+    """
+    Read a manifest from its JSON form, checking that the piece hashes fit
+    the size and piece length and that the root matches them. Raises
+    ValueError if anything is off.
+    """
+    try:
+        size = data["size"]
+        piece_length = data["piece_length"]
+        pieces = base64.b64decode(data["pieces"], validate=True)
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"missing or malformed field {e}")
+    # Booleans are ints to Python but not to anyone sending JSON
+    if any(not isinstance(value, int) or isinstance(value, bool) for value in (size, piece_length)):
+        raise ValueError("Size and piece length must be integers")
+    if size < 0 or not 0 < piece_length <= MAX_PIECE_LENGTH:
+        raise ValueError("Invalid size or piece length")
+    expected = (size + piece_length - 1) // piece_length
+    if len(pieces) != expected * HASH_SIZE:
+        raise ValueError(f"Manifest has {len(pieces) // HASH_SIZE} piece hashes, expected {expected}")
+
+    root = root_hash(size, piece_length, pieces)
+    if "root" in data and data["root"] != root:
+        raise ValueError("Root hash does not match the piece hashes")
+    return {"size": size, "piece_length": piece_length, "pieces": pieces, "root": root}
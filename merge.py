@@ -3,22 +3,54 @@ import argparse
 import glob
 import shutil
 
-def merge_file_chunks(filename_pattern, output_file):
+def merge_file_chunks(filename_pattern, output_file, piece_length=None, size=None):
     """
     Merge file chunks into a single output file.
     
     Args:
         filename_pattern: Pattern to match chunk files (e.g., "example.mp4.*")
         output_file: Path to the output file
+        piece_length: The file's piece length from the tracker (see
+            /file/<id>); when given, every chunk is written at its own
+            offset and chunks that are missing or of the wrong size are
+            reported instead of being merged into a broken file
+        size: The file's size from the tracker; with ``piece_length`` it
+            tells how many chunks there are, so missing chunks at the end
+            are caught too (without it the highest chunk found is taken
+            to be the last)
     """
     # Get a list of all chunk files matching the pattern
-    chunk_files = sorted(glob.glob(filename_pattern), 
+    # (skipping other matches such as a download's .bitfield sidecar)
+    chunk_files = sorted((f for f in glob.glob(filename_pattern) if f.split('.')[-1].isdigit()),
                           key=lambda x: int(x.split('.')[-1]))
     
     if not chunk_files:
         print(f"Error: No chunk files found matching pattern '{filename_pattern}'")
         return False
     
+    if piece_length is not None:
+        indices = [int(chunk_file.split('.')[-1]) for chunk_file in chunk_files]
+        num_chunks = indices[-1] + 1 if size is None else (size + piece_length - 1) // piece_length
+        if indices[-1] >= num_chunks:
+            print(f"Error: Chunk {chunk_files[-1]} is past the end of a {size}-byte file")
+            return False
+        if indices != list(range(num_chunks)):
+            missing = sorted(set(range(num_chunks)) - set(indices))
+            print(f"Error: Missing chunks {missing}")
+            return False
+        for chunk_file in chunk_files[:-1]:
+            if os.path.getsize(chunk_file) != piece_length:
+                print(f"Error: Chunk {chunk_file} is not {piece_length} bytes")
+                return False
+        if size is not None:
+            last_size = size - (num_chunks - 1) * piece_length
+            if os.path.getsize(chunk_files[-1]) != last_size:
+                print(f"Error: Chunk {chunk_files[-1]} is not {last_size} bytes")
+                return False
+        elif not 0 < os.path.getsize(chunk_files[-1]) <= piece_length:
+            print(f"Error: Chunk {chunk_files[-1]} is not between 1 and {piece_length} bytes")
+            return False
+    
     # Create output directory if it doesn't exist
     output_dir = os.path.dirname(output_file)
     if output_dir and not os.path.exists(output_dir):
@@ -28,8 +60,10 @@ def merge_file_chunks(filename_pattern, output_file):
     
     # Merge chunks into the output file
     with open(output_file, 'wb') as outfile:
-        for chunk_file in chunk_files:
+        for index, chunk_file in enumerate(chunk_files):
             print(f"Processing chunk: {chunk_file}")
+            if piece_length is not None:
+                outfile.seek(index * piece_length)
             with open(chunk_file, 'rb') as infile:
                 shutil.copyfileobj(infile, outfile)
     
@@ -40,10 +74,15 @@ def main():
     parser = argparse.ArgumentParser(description='Merge file chunks')
     parser.add_argument('--pattern', required=True, help='Pattern to match chunk files (e.g., "downloads/example.mp4.*")')
     parser.add_argument('--output', required=True, help='Path to the output file')
+    parser.add_argument('--piece-length', type=int, help="The file's piece length, to check the chunks against")
+    parser.add_argument('--size', type=int, help="The file's size in bytes, to check that no chunk is missing at the end")
     
     args = parser.parse_args()
+    if args.size is not None and args.piece_length is None:
+        parser.error("--size needs --piece-length")
     
-    merge_file_chunks(args.pattern, args.output)
+    if not merge_file_chunks(args.pattern, args.output, args.piece_length, args.size):
+        raise SystemExit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
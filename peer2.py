@@ -1,21 +1,40 @@
 import os
-import hashlib
-import requests
 import json
 import socket
 import threading
 import time
 import uuid
 import argparse
+import base64
 import logging
-from flask import Flask, request, jsonify
+import mimetypes
+import random
+import sys
+from array import array
+from flask import Flask, Response, request, jsonify
+
+import bitfield
+import connection_pool
+import file_cache
+import download_engine
+import manifest
+import peer_scoring
+import peer_exchange
+import piece_file
+import piece_picker
 
 
 # Global variables
 TRACKER_URL = "http://localhost:5000"
 DOWNLOAD_DIR = "downloads"
 UPLOAD_DIR = "uploads"
-CHUNK_SIZE = 1024 * 1024  # 1MB chunks
+SPLIT_CHUNKS = False  # Also keep a copy of shared files as chunk files in UPLOAD_DIR
+NUMWANT = 50  # Peers to ask the tracker for when downloading
+RECV_SIZE = 16 * 1024  # Bytes read from a peer's response at a time
+PIECE_STRATEGY = piece_picker.DEFAULT_STRATEGY  # Order to download chunks in
+STREAM_WINDOW = 16 * 1024 * 1024  # Bytes ahead of the read position a streaming download fetches first
+STREAM_WAIT = 10  # Seconds /stream waits for a chunk that hasn't arrived yet
+ALLOW_UNVERIFIED = False  # Download files the tracker has no manifest for, without checking their chunks
 peer_id = str(uuid.uuid4())[:8]
 peer_port = None
 active_downloads = {}
@@ -27,6 +46,21 @@ shared_files = {}
 # Initialize Flask app for peer server
 app = Flask(__name__)
 
+# Destination files of running downloads; their finished chunks are served too
+piece_files = {}
+# Piece pickers of streaming downloads, moved along by /stream readers
+stream_pickers = {}
+# Thread of the latest download of each file
+download_threads = {}
+# Open handles of shared files, for serving chunks without reopening them
+open_files = file_cache.FileCache()
+# Keep-alive connections to the tracker and to every peer we talk to
+pools = connection_pool.ConnectionPools()
+# How fast each remote peer serves us, and which peers we serve
+peer_scores = peer_scoring.PeerScores()
+choker = peer_scoring.Choker(peer_scores.throughput)
+# Peers we know per file, passed on to other peers through /pex
+pex = peer_exchange.PeerExchange()
 
 # Create directories if they don't exist
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
@@ -46,62 +80,65 @@ def get_peer_address():
         s.close()
     return ip
 
-def calculate_file_id(filepath):
-    """Generate a file ID based on file attributes"""
-    file_size = os.path.getsize(filepath)
-    filename = os.path.basename(filepath)
-    
-    # In a real implementation, you would include a hash of file contents
-    unique_string = f"{filename}-{file_size}-{time.time()}"
-    return hashlib.sha256(unique_string.encode()).hexdigest()[:16]
-
 def split_file(filepath):
-    """Split a file into chunks and return chunk info"""
+    """
+    Describe a file's chunks and hash them in one pass. The chunk size is
+    picked from the file size (see manifest.piece_length_for). Chunks are
+    served in place from the original file, so each one is just an offset
+    and a size in it; with SPLIT_CHUNKS they are also copied into
+    UPLOAD_DIR as separate chunk files. Returns the chunk info together
+    with the file's manifest (see manifest.py).
+    """
     file_size = os.path.getsize(filepath)
     filename = os.path.basename(filepath)
-    
-    # Calculate number of chunks
-    num_chunks = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
+    piece_length = manifest.piece_length_for(file_size)
     
     chunks = []
-    with open(filepath, 'rb') as f:
-        for i in range(num_chunks):
-            chunk_data = f.read(CHUNK_SIZE)
-            
+    
+    def add_chunk(i, chunk_data):
+        chunk = {
+            "index": i,
+            "offset": i * piece_length,
+            "size": len(chunk_data)
+        }
+        
+        if SPLIT_CHUNKS:
             # Create a chunk file
-            chunk_filename = f"{filename}.{i}"
-            chunk_path = os.path.join(UPLOAD_DIR, chunk_filename)
-            
-            with open(chunk_path, 'wb') as chunk_file:
+            chunk["filename"] = f"{filename}.{i}"
+            with open(os.path.join(UPLOAD_DIR, chunk["filename"]), 'wb') as chunk_file:
                 chunk_file.write(chunk_data)
-            
-            # Add chunk info (you can also add checksums here)
-            chunks.append({
-                "index": i,
-                "filename": chunk_filename,
-                "size": len(chunk_data)
-            })
+        
+        chunks.append(chunk)
+    
+    file_manifest = manifest.build(filepath, piece_length, on_piece=add_chunk)
     
     return {
         "filename": filename,
         "size": file_size,
-        "num_chunks": num_chunks,
-        "chunks": chunks
+        "piece_length": piece_length,
+        "num_chunks": len(chunks),
+        "chunks": chunks,
+        "manifest": file_manifest
     }
 
 def share_file(filepath):
-    """Share a file by splitting it and registering with tracker"""
+    """Share a file in place by hashing its chunks and registering with tracker"""
     if not os.path.exists(filepath):
         return {"error": f"File {filepath} does not exist"}
     
-    # Split the file and get chunk info
+    # Chunks are served from the file itself, wherever the CLI was started
+    filepath = os.path.abspath(filepath)
+    
+    # Hash the file and get chunk info
     file_info = split_file(filepath)
     
-    # Calculate file ID
-    file_id = calculate_file_id(filepath)
+    # The file ID comes from the content, so everyone sharing this file
+    # ends up in the same swarm
+    file_manifest = file_info["manifest"]
+    file_id = manifest.file_id(file_manifest["root"])
     
     # Register with tracker
-    response = requests.post(
+    response = pools.tracker().post(
         f"{TRACKER_URL}/announce",
         json={
             "peer_id": peer_id,
@@ -109,7 +146,10 @@ def share_file(filepath):
             "port": peer_port,
             "filename": file_info["filename"],
             "size": file_info["size"],
-            "chunks": file_info["num_chunks"]
+            "num_chunks": file_info["num_chunks"],
+            "manifest": manifest.to_json(file_manifest),
+            "seeder": True,
+            "compact": True
         }
     )
     
@@ -119,16 +159,12 @@ def share_file(filepath):
             "filename": file_info["filename"],
             "size": file_info["size"],
             "chunks": list(range(file_info["num_chunks"])),
-            "path": filepath
+            "piece_length": file_info["piece_length"],
+            "path": filepath,
+            "root": file_manifest["root"]
         }
         
-        # Start a background thread to periodically announce to tracker
-        threading.Thread(
-            target=announce_periodically,
-            args=(file_id, file_info["num_chunks"]),
-            daemon=True
-        ).start()
-        
+        # The announce scheduler keeps re-announcing it from now on
         return {
             "success": True,
             "file_id": file_id,
@@ -143,189 +179,463 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("PeerAnnounce")
 
 ANNOUNCE_INTERVAL = 60  # seconds (can be modified if needed)
-def announce_periodically(file_id, num_chunks):
-    """Periodically announce to tracker for a specific file"""
-    logger.info(f"Starting periodic announcements for file: {file_id}")
+HAVE_INTERVAL = 5  # seconds between reports of newly downloaded chunks
+ANNOUNCE_BATCH_SIZE = 200  # files per /announce/batch request
 
-    while file_id in shared_files:
-        try:
-            response = requests.post(
-                f"{TRACKER_URL}/announce",
-                json={
-                    "peer_id": peer_id,
+# Set to make the scheduler announce right away instead of at its next tick
+announce_wakeup = threading.Event()
+
+def announce_scheduler():
+    """
+    Announce every shared file and active download from one background
+    thread. Shared files are re-announced as seeders every
+    ANNOUNCE_INTERVAL. Downloads report their new chunks as delta
+    announces every HAVE_INTERVAL, and send a full bitfield when they
+    start or when the tracker asks for a resync. Everything due in a tick
+    goes out together through /announce/batch.
+    """
+    logger.info("Starting announce scheduler")
+    last_keepalive = 0
+    
+    while True:
+        keepalive = time.time() - last_keepalive >= ANNOUNCE_INTERVAL
+        if keepalive:
+            last_keepalive = time.time()
+        
+        # Each entry is paired with the download it reports on (None for a
+        # shared file), its seq and how many queued chunks it covers
+        entries = []
+        if keepalive:
+            for file_id in list(shared_files):
+                entries.append(({"file_id": file_id, "seeder": True}, None, 0, 0))
+        
+        for file_id, state in list(active_downloads.items()):
+            queued = len(state["unannounced_chunks"])
+            if not state["active"] or (file_id in shared_files and not queued):
+                continue
+            
+            seq = state["announce_seq"] + 1
+            if state["needs_full"]:
+                entry = {
+                    "file_id": file_id,
+                    "bitfield": bitfield.encode(bitfield.from_indices(state["downloaded_chunks"], state["total_chunks"])),
+                    "seq": seq
+                }
+            elif queued or keepalive:
+                entry = {
                     "file_id": file_id,
-                    "port": peer_port,
-                    "chunks": list(range(num_chunks))
+                    "have": state["unannounced_chunks"][:queued],
+                    "seq": seq
                 }
-            )
-            if response.status_code == 200:
-                logger.info(f"Announced file {file_id} successfully.")
             else:
-                logger.warning(f"Announce failed for file {file_id}: {response.status_code} {response.text}")
-
-        except Exception as e:
-            logger.error(f"Failed to announce file {file_id} to tracker: {e}")
-
-        time.sleep(ANNOUNCE_INTERVAL)  # Announce at the configured interval
-
-    logger.info(f"Stopped announcements for file: {file_id}")
+                continue
+            entries.append((entry, state, seq, queued))
+        
+        for start in range(0, len(entries), ANNOUNCE_BATCH_SIZE):
+            batch = entries[start:start + ANNOUNCE_BATCH_SIZE]
+            try:
+                response = pools.tracker().post(
+                    f"{TRACKER_URL}/announce/batch",
+                    json={
+                        "peer_id": peer_id,
+                        "port": peer_port,
+                        # Downloads get their peer lists from /file/<id>
+                        "numwant": 0,
+                        "files": [entry for entry, _, _, _ in batch]
+                    }
+                )
+                if response.status_code != 200:
+                    logger.warning(f"Batch announce failed: {response.status_code} {response.text}")
+                    continue
+                
+                for (entry, state, seq, queued), result in zip(batch, response.json()["results"]):
+                    if state is None:
+                        if result["status"] != 200:
+                            logger.warning(f"Announce failed for file {entry['file_id']}: {result}")
+                    elif result["status"] == 200:
+                        state["announce_seq"] = seq
+                        state["needs_full"] = False
+                        del state["unannounced_chunks"][:queued]
+                    elif result["status"] == 409:
+                        # The tracker lost a delta or forgot us; send everything
+                        state["needs_full"] = True
+                        announce_wakeup.set()
+                
+                logger.info(f"Announced {len(batch)} files successfully.")
+            except Exception as e:
+                # Queued chunks stay queued and go out with the next announce
+                logger.error(f"Failed to announce to tracker: {e}")
+        
+        announce_wakeup.wait(HAVE_INTERVAL)
+        announce_wakeup.clear()
 
-def download_file(file_id):
-    """Download a file by fetching chunks from peers"""
+def download_file(file_id, streaming=False):
+    """
+    Download a file by fetching chunks from peers. A streaming download
+    fetches the chunks ahead of where /stream is reading first.
+    """
+    if file_id in active_downloads and active_downloads[file_id]["active"]:
+        return {"error": "File is already being downloaded"}
+    
+    # A cancelled download of the file may still be winding down; it has to
+    # let go of the destination and write its journal before we take over
+    if file_id in download_threads:
+        download_threads[file_id].join()
+    
     # Get file info from tracker
-    response = requests.get(f"{TRACKER_URL}/file/{file_id}")
+    response = pools.tracker().get(f"{TRACKER_URL}/file/{file_id}", params={"compact": 1, "numwant": NUMWANT})
     
     if response.status_code != 200:
         return {"error": "Failed to get file info from tracker"}
     
     file_info = response.json()
-    filename = file_info["filename"]
+    # The name comes from whoever registered the file, so it must not lead
+    # out of DOWNLOAD_DIR, to a hidden file or to another download's sidecar
+    filename = os.path.basename(str(file_info["filename"]))
+    if not filename or filename.startswith('.') or \
+            filename.endswith((piece_file.SIDECAR_SUFFIX, piece_file.JOURNAL_SUFFIX)):
+        return {"error": f"Refusing to download to file name {file_info['filename']!r}"}
     total_chunks = file_info["chunks"]
-    peers = file_info["peers"]
+    piece_length = file_info.get("piece_length", manifest.DEFAULT_PIECE_LENGTH)
+    peers = bitfield.decode_peers(file_info["peers"])
+    peers.pop(peer_id, None)
     
     if not peers:
         return {"error": "No peers available for this file"}
     
+    # Piece hashes to check every chunk against before it is kept
+    try:
+        file_manifest = get_manifest(file_id, piece_length)
+    except ValueError as e:
+        return {"error": f"Bad manifest from tracker: {e}"}
+    if file_manifest is None:
+        if not ALLOW_UNVERIFIED:
+            return {"error": "No manifest for this file, its chunks can't be verified (see --allow-unverified)"}
+        print(f"No manifest for file {file_id}, chunks will not be verified")
+    
+    # Chunks are written straight into the preallocated destination file;
+    # what an earlier, interrupted download of it left there is kept
+    path = os.path.join(DOWNLOAD_DIR, filename)
+    journal = piece_file.load_journal(path)
+    resume = (
+        journal is not None and journal.get("file_id") == file_id
+        and journal.get("size") == file_info["size"] and journal.get("piece_length") == piece_length
+    )
+    destination = piece_file.PieceFile(path, file_info["size"], piece_length, resume=resume)
+    save_download_journal(file_id, filename, destination, file_manifest)
+    
+    start_download(file_id, filename, destination, peers, file_manifest, streaming)
+    
+    return {
+        "success": True,
+        "file_id": file_id,
+        "filename": filename,
+        "total_chunks": total_chunks,
+        "message": f"Started downloading {filename}"
+    }
+
+def save_download_journal(file_id, filename, destination, file_manifest, cancelled=False):
+    """Record what a download is next to its destination, so it survives a restart"""
+    piece_file.save_journal(destination.path, {
+        "file_id": file_id,
+        "filename": filename,
+        "size": destination.size,
+        "piece_length": destination.piece_length,
+        "manifest": manifest.to_json(file_manifest) if file_manifest is not None else None,
+        "cancelled": cancelled
+    })
+
+def start_download(file_id, filename, destination, peers, file_manifest, streaming=False):
+    """Track a download and fetch its missing chunks in a background thread"""
     # Initialize download state
     download_state = {
         "filename": filename,
-        "total_chunks": total_chunks,
+        "total_chunks": destination.num_pieces,
         "downloaded_chunks": [],
+        "announce_seq": 0,
+        "unannounced_chunks": [],
+        "needs_full": True,
         "active": True,
+        "streaming": streaming,
         "started_at": time.time()
     }
     
     active_downloads[file_id] = download_state
     
+    # Let the tracker know we're downloading this file
+    announce_wakeup.set()
+    
     # Start download in a background thread
-    threading.Thread(
+    download_threads[file_id] = threading.Thread(
         target=download_chunks_from_peers,
-        args=(file_id, download_state, peers),
+        args=(file_id, download_state, destination, peers, file_manifest),
         daemon=True
-    ).start()
-    
-    return {
-        "success": True,
-        "file_id": file_id,
-        "filename": filename,
-        "total_chunks": total_chunks,
-        "message": f"Started downloading {filename}"
-    }
+    )
+    download_threads[file_id].start()
 
-def download_chunks_from_peers(file_id, download_state, peers):
-    """Download file chunks from available peers"""
-    filename = download_state["filename"]
-    total_chunks = download_state["total_chunks"]
-    
-    # Announce that we're downloading this file
-    try:
-        requests.post(
-            f"{TRACKER_URL}/announce",
-            json={
-                "peer_id": peer_id,
-                "file_id": file_id,
-                "port": peer_port,
-                "chunks": download_state["downloaded_chunks"]
-            }
-        )
-    except:
-        print(f"Failed to announce download of file {file_id} to tracker")
-    
-    # For each chunk, find a peer that has it and download
-    for chunk_index in range(total_chunks):
-        # If download was cancelled
-        if not download_state["active"]:
-            return
+def resume_downloads():
+    """
+    Pick up the downloads an earlier run of this peer left unfinished in
+    DOWNLOAD_DIR, except the ones that were cancelled
+    """
+    for path in piece_file.find_journals(DOWNLOAD_DIR):
+        journal = piece_file.load_journal(path)
+        try:
+            file_id = journal["file_id"]
+            filename = journal["filename"]
+            size = int(journal["size"])
+            piece_length = int(journal["piece_length"])
+            file_manifest = manifest.from_json(journal["manifest"]) if journal["manifest"] else None
+        except (TypeError, KeyError, ValueError) as e:
+            print(f"Skipping unreadable download journal for {path}: {e}")
+            continue
         
-        # Check if we already have this chunk
-        if chunk_index in download_state["downloaded_chunks"]:
+        if journal.get("cancelled") or file_id in active_downloads:
+            continue
+        if file_manifest is None and not ALLOW_UNVERIFIED:
+            print(f"Skipping download of {filename}: no manifest to verify its chunks against")
+            continue
+        if file_manifest is not None and (
+            manifest.file_id(file_manifest["root"]) != file_id or file_manifest["piece_length"] != piece_length
+        ):
+            print(f"Skipping download of {filename}: manifest does not match file {file_id}")
             continue
         
-        # Find a peer with this chunk
-        chunk_downloaded = False
-        for p_id, peer_info in peers.items():
-            if chunk_index in peer_info["chunks"]:
-                try:
-                    # Request the chunk from the peer
-                    peer_url = f"http://{peer_info['ip']}:{peer_info['port']}/chunk"
-                    response = requests.get(
-                        peer_url,
-                        params={"file_id": file_id, "chunk_index": chunk_index},
-                        timeout=10
-                    )
-                    
-                    if response.status_code == 200:
-                        # Save the chunk
-                        chunk_path = os.path.join(DOWNLOAD_DIR, f"{filename}.{chunk_index}")
-                        with open(chunk_path, 'wb') as f:
-                            f.write(response.content)
-                        
-                        # Update download state
-                        download_state["downloaded_chunks"].append(chunk_index)
-                        print(f"Downloaded chunk {chunk_index+1}/{total_chunks} of {filename}")
-                        chunk_downloaded = True
-                        
-                        # Announce our new chunk to the tracker
-                        try:
-                            requests.post(
-                                f"{TRACKER_URL}/announce",
-                                json={
-                                    "peer_id": peer_id,
-                                    "file_id": file_id,
-                                    "port": peer_port,
-                                    "chunks": download_state["downloaded_chunks"]
-                                }
-                            )
-                        except:
-                            print(f"Failed to announce new chunk to tracker")
-                        
-                        break
-                except Exception as e:
-                    print(f"Failed to download chunk {chunk_index} from peer {p_id}: {e}")
+        destination = piece_file.PieceFile(path, size, piece_length, resume=True)
+        # Peers are looked up once the download thread is running
+        start_download(file_id, filename, destination, {}, file_manifest)
+
+def get_peers(file_id):
+    """Ask the tracker for peers that have a file, leaving ourselves out"""
+    response = pools.tracker().get(f"{TRACKER_URL}/file/{file_id}", params={"compact": 1, "numwant": NUMWANT})
+    if response.status_code != 200:
+        return None
+    peers = bitfield.decode_peers(response.json()["peers"])
+    peers.pop(peer_id, None)
+    return peers
+
+def get_pex(file_id, remote_id, peer_info):
+    """
+    Ask a peer which peers it knows for a file. The answer includes the
+    peer itself, with what it has of the file right now.
+    """
+    response = pools.peer(peer_info).get(
+        f"http://{peer_info['ip']}:{peer_info['port']}/pex",
+        params={"file_id": file_id, "peer_id": peer_id},
+        timeout=5
+    )
+    if response.status_code != 200:
+        return {}
+    data = response.json()
+    peers = peer_exchange.from_json(data.get("peers"))
+    responder = dict(data.get("self") or {}, ip=peer_info["ip"], port=peer_info["port"], seen=time.time())
+    peers.update(bitfield.decode_peers({remote_id: responder}))
+    peers.pop(peer_id, None)
+    return peers
+
+def get_manifest(file_id, piece_length):
+    """
+    Get a file's piece hashes from the tracker. Returns None for files
+    shared without a manifest; raises ValueError if the manifest doesn't
+    belong to the file ID or doesn't have the file's piece length.
+    """
+    response = pools.tracker().get(f"{TRACKER_URL}/file/{file_id}/manifest")
+    if response.status_code != 200:
+        return None
+    file_manifest = manifest.from_json(response.json())
+    if manifest.file_id(file_manifest["root"]) != file_id:
+        raise ValueError("root hash does not match the file ID")
+    if file_manifest["piece_length"] != piece_length:
+        raise ValueError(f"piece length {file_manifest['piece_length']} is not {piece_length}")
+    return file_manifest
+
+def get_availability(file_id):
+    """Ask the tracker how many peers in the whole swarm hold each chunk"""
+    try:
+        response = pools.tracker().get(f"{TRACKER_URL}/file/{file_id}/availability", params={"compact": 1})
+        if response.status_code != 200:
+            return None
+        data = response.json()
+    except Exception:
+        return None
+    counts = array('I', base64.b64decode(data["counts"]))
+    if sys.byteorder != 'little':
+        counts.byteswap()
+    return [count + data["seeders"] for count in counts]
+
+def fetch_block(file_id, peer_info, chunk_index, begin, length, cancelled=None):
+    """
+    Request ``length`` bytes at offset ``begin`` of a chunk from a peer with
+    a Range request, reading the response straight into a preallocated
+    buffer and giving up early once ``cancelled`` is set
+    """
+    peer_url = f"http://{peer_info['ip']}:{peer_info['port']}/chunk"
+    with pools.peer(peer_info).get(
+        peer_url,
+        params={"file_id": file_id, "chunk_index": chunk_index, "peer_id": peer_id, "port": peer_port},
+        headers={"Range": f"bytes={begin}-{begin + length - 1}"},
+        timeout=10,
+        stream=True
+    ) as response:
+        if response.status_code == 503:
+            raise download_engine.PeerChoked(int(response.headers.get('Retry-After', download_engine.RETRY_DELAY)))
+        if response.status_code == 200:
+            # The peer ignored the range and sends the whole chunk
+            skip = begin
+        elif response.status_code == 206:
+            skip = 0
+        else:
+            raise IOError(f"Peer answered {response.status_code}")
         
-        if not chunk_downloaded:
-            print(f"Failed to download chunk {chunk_index}. Will retry later.")
-            time.sleep(5)  # Wait a bit and retry
-            
-            # Update peers list
+        block = bytearray(length)
+        view = memoryview(block)
+        received = -skip
+        while received < length:
+            if cancelled is not None and cancelled.is_set():
+                raise IOError("Request cancelled")
+            if received < 0:
+                read = len(response.raw.read(min(RECV_SIZE, -received)))
+            else:
+                read = response.raw.readinto(view[received:received + RECV_SIZE])
+            if not read:
+                raise IOError("Peer closed the connection early")
+            received += read
+        return block
+
+def download_chunks_from_peers(file_id, download_state, destination, peers, file_manifest=None):
+    """
+    Download file chunks from available peers into ``destination``, many
+    at a time, checking each against the manifest's piece hashes when
+    there is one
+    """
+    filename = download_state["filename"]
+    total_chunks = download_state["total_chunks"]
+    
+    verify_chunk = None
+    if file_manifest is not None:
+        def verify_chunk(chunk_index, chunk_data):
+            return manifest.verify_piece(file_manifest, chunk_index, chunk_data)
+    
+    if destination.count():
+        # Chunks left by an earlier run are only trusted once their hashes
+        # check out again; a crash may have hit between a chunk and its bit
+        if verify_chunk is not None:
+            dropped = destination.verify(verify_chunk, download_engine.HASH_WORKERS)
+            if dropped:
+                print(f"Dropped {len(dropped)} chunks of {filename} that failed verification")
+        resumed = bitfield.to_indices(destination.bits, total_chunks)
+        download_state["downloaded_chunks"].extend(resumed)
+        download_state["unannounced_chunks"].extend(resumed)
+        print(f"Resuming {filename} with {len(resumed)}/{total_chunks} chunks")
+    
+    # Chunks on disk can be served while the rest download
+    piece_files[file_id] = destination
+    
+    # Peers are found through PEX; the tracker is only asked every
+    # peer_exchange.TRACKER_INTERVAL, or sooner when we know too few peers
+    pex.add(file_id, peers)
+    last_tracker_query = time.time() if peers else 0
+    tracker_round = True
+    
+    def refresh_peers():
+        nonlocal last_tracker_query, tracker_round
+        known = pex.peers(file_id)
+        known.pop(peer_id, None)
+        tracker_round = (
+            time.time() - last_tracker_query >= peer_exchange.TRACKER_INTERVAL
+            or len(known) < peer_exchange.MIN_PEERS
+        )
+        if tracker_round:
             try:
-                response = requests.get(f"{TRACKER_URL}/file/{file_id}")
-                if response.status_code == 200:
-                    peers = response.json()["peers"]
-            except:
+                tracker_peers = get_peers(file_id)
+            except Exception:
+                tracker_peers = None
+            if tracker_peers is None:
                 print("Failed to update peers list from tracker")
+            else:
+                pex.add(file_id, tracker_peers)
+                last_tracker_query = time.time()
+        
+        # Ask a few of the peers we know whom they know
+        for remote_id in random.sample(sorted(known), min(peer_exchange.FANOUT, len(known))):
+            try:
+                pex.add(file_id, get_pex(file_id, remote_id, known[remote_id]))
+            except Exception:
+                pass
+        
+        peers = pex.peers(file_id)
+        peers.pop(peer_id, None)
+        return peers
     
-    # Check if all chunks downloaded
-    if len(download_state["downloaded_chunks"]) == total_chunks:
-        # Merge chunks into the final file
-        merge_chunks(filename, total_chunks)
+    def fetch_availability():
+        # Swarm-wide counts come with the tracker queries; in between the
+        # picker counts from the bitfields PEX brings in
+        return get_availability(file_id) if tracker_round else None
+    
+    if not peers:
+        peers = refresh_peers()
+    
+    if download_state["streaming"]:
+        window = max(1, STREAM_WINDOW // destination.piece_length)
+        picker = piece_picker.StreamingPicker(total_chunks, download_state["downloaded_chunks"], window)
+        stream_pickers[file_id] = picker
+    else:
+        picker = piece_picker.create(PIECE_STRATEGY, total_chunks, download_state["downloaded_chunks"])
+    
+    def store_chunk(chunk_index, chunk_data):
+        # Write the chunk at its place in the destination file
+        destination.write(chunk_index, chunk_data)
         
-        # Update shared files (we now have the complete file)
-        shared_files[file_id] = {
-            "filename": filename,
-            "size": os.path.getsize(os.path.join(DOWNLOAD_DIR, filename)),
-            "chunks": list(range(total_chunks)),
-            "path": os.path.join(DOWNLOAD_DIR, filename)
-        }
+        # Update download state
+        download_state["downloaded_chunks"].append(chunk_index)
+        print(f"Downloaded chunk {chunk_index+1}/{total_chunks} of {filename}")
         
-        print(f"Download of {filename} completed!")
-
-def merge_chunks(filename, total_chunks):
-    """Merge downloaded chunks into a single file"""
-    output_path = os.path.join(DOWNLOAD_DIR, filename)
+        # Queue our new chunk for the next announce
+        download_state["unannounced_chunks"].append(chunk_index)
+    
+    engine = download_engine.DownloadEngine(
+        total_chunks,
+        peers,
+        fetch_block=lambda peer_info, chunk_index, begin, length, cancelled:
+            fetch_block(file_id, peer_info, chunk_index, begin, length, cancelled),
+        store_chunk=store_chunk,
+        refresh_peers=refresh_peers,
+        chunk_size=destination.piece_size,
+        have=download_state["downloaded_chunks"],
+        is_active=lambda: download_state["active"],
+        picker=picker,
+        fetch_availability=fetch_availability,
+        scores=peer_scores,
+        verify_chunk=verify_chunk
+    )
+    complete = engine.run() and destination.is_complete()
+    # Only drop what is still ours, not a newer download's
+    if stream_pickers.get(file_id) is picker:
+        del stream_pickers[file_id]
+    if not complete:
+        # Cancelled; what was downloaded stays on disk with its sidecar and
+        # journal, to be resumed by downloading the file again
+        if piece_files.get(file_id) is destination:
+            del piece_files[file_id]
+        destination.close()
+        save_download_journal(file_id, filename, destination, file_manifest, cancelled=True)
+        return
+    
+    # Every chunk is already in place, so the file is done as it is
+    destination.finish()
     
-    with open(output_path, 'wb') as outfile:
-        for i in range(total_chunks):
-            chunk_path = os.path.join(DOWNLOAD_DIR, f"{filename}.{i}")
-            if os.path.exists(chunk_path):
-                with open(chunk_path, 'rb') as chunk_file:
-                    outfile.write(chunk_file.read())
+    # Update shared files (we now have the complete file)
+    shared_files[file_id] = {
+        "filename": filename,
+        "size": destination.size,
+        "chunks": list(range(total_chunks)),
+        "piece_length": destination.piece_length,
+        "path": destination.path
+    }
+    if piece_files.get(file_id) is destination:
+        del piece_files[file_id]
     
-    # Optionally, clean up chunk files
-    for i in range(total_chunks):
-        chunk_path = os.path.join(DOWNLOAD_DIR, f"{filename}.{i}")
-        if os.path.exists(chunk_path):
-            os.remove(chunk_path)
+    print(f"Download of {filename} completed!")
 
 def cancel_download(file_id):
     """Cancel an active download"""
@@ -337,32 +647,183 @@ def cancel_download(file_id):
 
 @app.route('/chunk', methods=['GET'])
 def serve_chunk():
-    """Serve a chunk of a file to another peer"""
+    """
+    Serve a chunk of a file to another peer, streamed from a cached file
+    handle. A Range
+    header asks for part of the chunk (offsets within the chunk) and is
+    answered with 206.
+    """
     file_id = request.args.get('file_id')
-    chunk_index = int(request.args.get('chunk_index', 0))
+    chunk_index = request.args.get('chunk_index', '0')
+    chunk_index = int(chunk_index) if chunk_index.isdigit() else None
     
-    if file_id not in shared_files:
+    partial = piece_files.get(file_id)
+    if file_id in shared_files:
+        file_info = shared_files[file_id]
+    elif partial is not None:
+        # Still downloading: the chunks already on disk can be served
+        file_info = {
+            "filename": os.path.basename(partial.path),
+            "size": partial.size,
+            "piece_length": partial.piece_length,
+            "path": partial.path
+        }
+    else:
         return jsonify({"error": "File not found"}), 404
     
-    file_info = shared_files[file_id]
     filename = file_info["filename"]
+    piece_length = file_info["piece_length"]
+    num_chunks = (file_info["size"] + piece_length - 1) // piece_length
+    if chunk_index is None or not 0 <= chunk_index < num_chunks:
+        return jsonify({"error": "Invalid chunk index"}), 400
+    if file_id not in shared_files and not partial.has(chunk_index):
+        return jsonify({"error": "Chunk not available"}), 404
+    
+    # Only peers holding an upload slot get served; the rest come back later
+    requester = request.args.get('peer_id') or request.remote_addr
+    port = request.args.get('port', '')
+    if 'peer_id' in request.args and port.isdigit() and peer_exchange.is_valid_addr(request.remote_addr, int(port)):
+        # A peer downloading the file too; worth passing on through /pex
+        pex.add(file_id, {requester: {"ip": request.remote_addr, "port": int(port)}})
+    if not choker.request(requester):
+        return jsonify({"error": "Choked"}), 503, {"Retry-After": str(choker.retry_after())}
     
     # Check if this is a complete file or just chunks
     if os.path.exists(file_info["path"]):
-        # Complete file - read the specific chunk
-        with open(file_info["path"], 'rb') as f:
-            f.seek(chunk_index * CHUNK_SIZE)
-            chunk_data = f.read(CHUNK_SIZE)
+        # Complete file - the chunk is a slice of it
+        path = file_info["path"]
+        offset = chunk_index * piece_length
+        length = min(piece_length, file_info["size"] - offset)
     else:
         # We have chunks - serve the specific chunk file
-        chunk_path = os.path.join(UPLOAD_DIR, f"{filename}.{chunk_index}")
-        if not os.path.exists(chunk_path):
-            return jsonify({"error": "Chunk not found"}), 404
-        
-        with open(chunk_path, 'rb') as f:
-            chunk_data = f.read()
+        path = os.path.join(UPLOAD_DIR, f"{filename}.{chunk_index}")
+        offset = 0
+        length = None
+    
+    # A file still downloading is written to all the time; that doesn't
+    # make its cached handle stale
+    live = file_id not in shared_files
+    try:
+        file_size = open_files.size(path, live)
+    except OSError:
+        return jsonify({"error": "Chunk not found"}), 404
+    if length is None:
+        length = file_size
+    if offset + length > file_size:
+        # The file shrank since it was shared
+        return jsonify({"error": "Chunk not found"}), 404
+    
+    start, stop = offset, offset + length
+    status = 200
+    headers = {"Accept-Ranges": "bytes"}
+    if request.range and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            return jsonify({"error": "Range not satisfiable"}), 416, {"Content-Range": f"bytes */{length}"}
+        start, stop = offset + byte_range[0], offset + byte_range[1]
+        status = 206
+        headers["Content-Range"] = f"bytes {byte_range[0]}-{byte_range[1] - 1}/{length}"
+    headers["Content-Length"] = str(stop - start)
+    
+    choker.record_upload(requester, stop - start)
+    return Response(
+        open_files.body(path, start, stop, live),
+        status=status,
+        headers=headers,
+        mimetype='application/octet-stream',
+        direct_passthrough=True
+    )
+
+@app.route('/stream/<file_id>', methods=['GET'])
+def stream_file(file_id):
+    """
+    Serve a file to local programs such as a media player, also while it
+    is still downloading. Range requests are answered with 206. Bytes go
+    out as soon as their chunk is on disk; a missing chunk is waited for
+    up to STREAM_WAIT seconds, and reading moves the window of a
+    streaming download along.
+    """
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        return jsonify({"error": "Streaming is only available to local programs"}), 403
+    
+    partial = None
+    if file_id in shared_files:
+        file_info = shared_files[file_id]
+        path, size = file_info["path"], file_info["size"]
+    elif file_id in piece_files:
+        partial = piece_files[file_id]
+        path, size = partial.path, partial.size
+    else:
+        return jsonify({"error": "File not found"}), 404
+    
+    start, stop = 0, size
+    status = 200
+    headers = {"Accept-Ranges": "bytes"}
+    if request.range and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return jsonify({"error": "Range not satisfiable"}), 416, {"Content-Range": f"bytes */{size}"}
+        start, stop = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    headers["Content-Length"] = str(stop - start)
     
-    return chunk_data
+    if partial is not None and start < stop:
+        # Don't commit to a response until the first chunk is there
+        index = start // partial.piece_length
+        if file_id in stream_pickers:
+            stream_pickers[file_id].seek(index)
+        if not partial.wait_for(index, STREAM_WAIT):
+            return jsonify({"error": "Chunk not downloaded yet"}), 503, {"Retry-After": "1"}
+        body = stream_pieces(file_id, partial, start, stop)
+    else:
+        body = open_files.body(path, start, stop)
+    
+    return Response(
+        body,
+        status=status,
+        headers=headers,
+        mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream',
+        direct_passthrough=True
+    )
+
+def stream_pieces(file_id, partial, start, stop):
+    """Yield bytes ``start:stop`` of a file being downloaded, each chunk once it has arrived"""
+    fd = os.open(partial.path, os.O_RDONLY)
+    try:
+        offset = start
+        while offset < stop:
+            index = offset // partial.piece_length
+            if file_id in stream_pickers:
+                stream_pickers[file_id].seek(index)
+            if not partial.wait_for(index, STREAM_WAIT):
+                # Cut the response short; the reader can ask again with a Range
+                print(f"Stream of {os.path.basename(partial.path)} gave up waiting for chunk {index}")
+                return
+            end = min(stop, (index + 1) * partial.piece_length)
+            for block in range(offset, end, file_cache.BLOCK_SIZE):
+                yield os.pread(fd, min(file_cache.BLOCK_SIZE, end - block), block)
+            offset = end
+    finally:
+        os.close(fd)
+
+@app.route('/pex', methods=['GET'])
+def exchange_peers():
+    """
+    Peer exchange: the peers we know for a file, freshest first, with
+    compact addresses and ages (see peer_exchange.py), plus what we have
+    of the file ourselves
+    """
+    file_id = request.args.get('file_id')
+    if file_id in shared_files:
+        own = {"seeder": True}
+    elif file_id in piece_files:
+        own = {"bitfield": bitfield.encode(piece_files[file_id].bits)}
+    else:
+        return jsonify({"error": "File not found"}), 404
+    
+    exclude = (peer_id, request.args.get('peer_id'))
+    return jsonify({"file_id": file_id, "self": own, "peers": pex.to_json(file_id, exclude)})
 
 @app.route('/status', methods=['GET'])
 def get_status():
@@ -370,7 +831,11 @@ def get_status():
     return jsonify({
         "peer_id": peer_id,
         "shared_files": shared_files,
-        "active_downloads": active_downloads
+        "active_downloads": active_downloads,
+        "peer_scores": peer_scores.stats(),
+        "upload_slots": choker.stats(),
+        "connection_pools": pools.stats(),
+        "known_peers": pex.stats()
     })
 
 def start_peer_server(port):
@@ -378,6 +843,7 @@ def start_peer_server(port):
     global peer_port
     peer_port = port
     threading.Thread(target=lambda: app.run(host='0.0.0.0', port=port), daemon=True).start()
+    threading.Thread(target=announce_scheduler, daemon=True).start()
     print(f"Peer server started on port {port}")
 
 def print_help():
@@ -386,6 +852,7 @@ def print_help():
     print("Commands:")
     print("  list              - List available files from tracker")
     print("  download [id]     - Download a file by ID")
+    print("  stream [id]       - Download a file for use while it downloads")
     print("  share [path]      - Share a file from local storage")
     print("  status            - Show status of downloads and shared files")
     print("  cancel [id]       - Cancel an active download")
@@ -411,7 +878,7 @@ def cli():
             
             elif cmd[0] == "list":
                 try:
-                    response = requests.get(f"{TRACKER_URL}/list")
+                    response = pools.tracker().get(f"{TRACKER_URL}/list")
                     
                     if response.status_code == 200:
                         files = response.json()["files"]
@@ -420,13 +887,13 @@ def cli():
                             print("No files available")
                         else:
                             print("\nAvailable files:")
-                            print("-" * 60)
-                            print(f"{'ID':<18} {'Filename':<30} {'Size':<10} {'Peers'}")
-                            print("-" * 60)
+                            print("-" * 80)
+                            print(f"{'ID':<34} {'Filename':<30} {'Size':<10} {'Peers'}")
+                            print("-" * 80)
                             
                             for file_id, file_info in files.items():
                                 size_str = f"{file_info['size'] / (1024*1024):.2f} MB"
-                                print(f"{file_id:<18} {file_info['filename']:<30} {size_str:<10} {file_info['active_peers']}")
+                                print(f"{file_id:<34} {file_info['filename']:<30} {size_str:<10} {file_info['active_peers']}")
                     else:
                         print(f"Error getting file list: {response.text}")
                 except Exception as e:
@@ -445,6 +912,20 @@ def cli():
                 else:
                     print(f"Started downloading {result['filename']} ({result['total_chunks']} chunks)")
             
+            elif cmd[0] == "stream":
+                if len(cmd) < 2:
+                    print("Usage: stream [file_id]")
+                    continue
+                
+                file_id = cmd[1]
+                if file_id not in shared_files:
+                    result = download_file(file_id, streaming=True)
+                    if "error" in result:
+                        print(f"Error: {result['error']}")
+                        continue
+                    print(f"Started streaming {result['filename']} ({result['total_chunks']} chunks)")
+                print(f"Play or read it from http://127.0.0.1:{peer_port}/stream/{file_id}")
+            
             elif cmd[0] == "share":
                 if len(cmd) < 2:
                     print("Usage: share [filepath]")
@@ -503,12 +984,24 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='P2P File Sharing Peer')
     parser.add_argument('--port', type=int, default=8001, help='Port to run the peer server on')
     parser.add_argument('--tracker', type=str, default='http://localhost:5000', help='Tracker URL')
+    parser.add_argument('--split-chunks', action='store_true',
+                        help=f'Copy shared files into {UPLOAD_DIR}/ as chunk files instead of only serving them in place')
+    parser.add_argument('--piece-strategy', choices=sorted(piece_picker.STRATEGIES), default=piece_picker.DEFAULT_STRATEGY,
+                        help='Order to download chunks in')
+    parser.add_argument('--allow-unverified', action='store_true',
+                        help='Download files the tracker has no manifest for, without verifying their chunks')
     
     args = parser.parse_args()
     TRACKER_URL = args.tracker
+    PIECE_STRATEGY = args.piece_strategy
+    SPLIT_CHUNKS = args.split_chunks
+    ALLOW_UNVERIFIED = args.allow_unverified
     
     # Start the peer server
     start_peer_server(args.port)
     
+    # Carry on with downloads interrupted by the last shutdown
+    resume_downloads()
+    
     # Start the CLI
     cli()
@@ -0,0 +1,160 @@
+import base64
+import ipaddress
+import struct
+import threading
+import time
+
+import bitfield
+
+# Peer exchange (PEX). Every peer server answers GET /pex?file_id=... with
+# the peers it knows for that file, so downloaders learn about each other
+# from the swarm itself and only go back to the tracker now and then.
+#
+# Peers are listed freshest first, keyed by peer ID, each with a compact
+# address (the packed IPv4/IPv6 address followed by the big-endian port,
+# in base64), its age (seconds since the answering peer last heard of it)
+# and what it has, in the tracker's compact form:
+#
+#   {"file_id": "...", "self": {"seeder": true},
+#    "peers": {"ab12cd34": {"addr": "fwAAAR9B", "age": 12, "bitfield": "4A=="}}}
+#
+# "self" is what the answering peer has of the file itself.
+
+# Seconds after which a peer nobody has mentioned is forgotten
+MAX_AGE = 600
+# Most peers in one /pex answer
+MAX_PEERS = 50
+# Peers a downloader asks for their peer lists on each refresh
+FANOUT = 3
+# Below this many known peers a downloader asks the tracker right away
+MIN_PEERS = 5
+# Seconds between a downloader's tracker queries while PEX finds enough peers
+TRACKER_INTERVAL = 120
+
+
+def is_valid_addr(ip, port):
+    """Whether an IP and port can be reached and put in a compact address"""
+    if not isinstance(port, int) or isinstance(port, bool) or not 1 <= port <= 65535:
+        return False
+    try:
+        ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    return True
+
+
+def encode_addr(ip, port):
+    """Compact address of a peer in base64"""
+    return base64.b64encode(ipaddress.ip_address(ip).packed + struct.pack(">H", port)).decode("ascii")
+
+
+def decode_addr(text):
+    """(ip, port) of a compact address; raises ValueError if it is malformed"""
+    raw = base64.b64decode(text, validate=True)
+    if len(raw) not in (6, 18):
+        raise ValueError(f"Compact address of {len(raw)} bytes")
+    return str(ipaddress.ip_address(raw[:-2])), struct.unpack(">H", raw[-2:])[0]
+
+
+def from_json(peers, now=None):
+    """
+    Read the "peers" of a /pex answer into a ``{peer_id: peer_info}`` dict
+    with decoded bitfields and a "seen" time; malformed entries are skipped
+    """
+    now = time.time() if now is None else now
+    result = {}
+    if not isinstance(peers, dict):
+        return result
+    for peer_id, entry in peers.items():
+        try:
+            ip, port = decode_addr(entry["addr"])
+            peer_info = {"ip": ip, "port": port, "seen": now - max(0, float(entry.get("age", 0)))}
+            if entry.get("seeder"):
+                peer_info["seeder"] = True
+            elif "bitfield" in entry:
+                peer_info["bitfield"] = bitfield.decode(entry["bitfield"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        result[peer_id] = peer_info
+    return result
+
+
+class PeerExchange:
+    """The peers known per file, from the tracker and from other peers, with when each was last heard of"""
+
+    def __init__(self, max_age=MAX_AGE):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # file_id -> {peer_id: {"ip", "port", "seen", "seeder" or "bitfield"}}
+        self.files = {}
+
+    def add(self, file_id, peers, seen=None):
+        """
+        Merge a ``{peer_id: peer_info}`` dict into what we know of a file.
+        Entries without a "seen" time count as heard of at ``seen`` (now by
+        default); older news never replaces newer. An entry that doesn't
+        say what the peer has keeps what we knew.
+        """
+        seen = time.time() if seen is None else seen
+        with self.lock:
+            known = self.files.setdefault(file_id, {})
+            for peer_id, peer_info in peers.items():
+                if not isinstance(peer_info, dict) or not is_valid_addr(peer_info.get("ip"), peer_info.get("port")):
+                    continue
+                peer_seen = peer_info.get("seen", seen)
+                old = known.get(peer_id)
+                if old is not None and old["seen"] > peer_seen:
+                    continue
+                entry = {"ip": peer_info["ip"], "port": peer_info["port"], "seen": peer_seen}
+                if peer_info.get("seeder"):
+                    entry["seeder"] = True
+                elif "bitfield" in peer_info:
+                    entry["bitfield"] = peer_info["bitfield"]
+                elif old is not None:
+                    for key in ("seeder", "bitfield"):
+                        if key in old:
+                            entry[key] = old[key]
+                known[peer_id] = entry
+
+    def _fresh(self, file_id):
+        """Entries of a file that haven't expired, dropping the others"""
+        known = self.files.get(file_id, {})
+        cutoff = time.time() - self.max_age
+        for peer_id in [p for p, entry in known.items() if entry["seen"] < cutoff]:
+            del known[peer_id]
+        return known
+
+    def peers(self, file_id):
+        """The live peers of a file as a ``{peer_id: peer_info}`` dict in the tracker's (decoded) compact form"""
+        with self.lock:
+            return {
+                peer_id: {key: value for key, value in entry.items() if key != "seen"}
+                for peer_id, entry in self._fresh(file_id).items()
+            }
+
+    def to_json(self, file_id, exclude=(), limit=MAX_PEERS):
+        """The freshest peers of a file for a /pex answer, leaving out the ``exclude`` peer IDs"""
+        with self.lock:
+            now = time.time()
+            entries = sorted(self._fresh(file_id).items(), key=lambda item: item[1]["seen"], reverse=True)
+            result = {}
+            for peer_id, entry in entries:
+                if len(result) >= limit:
+                    break
+                if peer_id in exclude:
+                    continue
+                try:
+                    item = {"addr": encode_addr(entry["ip"], entry["port"]), "age": int(now - entry["seen"])}
+                except (ValueError, struct.error):
+                    continue
+                if entry.get("seeder"):
+                    item["seeder"] = True
+                elif "bitfield" in entry:
+                    item["bitfield"] = bitfield.encode(entry["bitfield"])
+                result[peer_id] = item
+            return result
+
+    def stats(self):
+        """Number of live peers known per file"""
+        with self.lock:
+            return {file_id: len(self._fresh(file_id)) for file_id in list(self.files)}
@@ -0,0 +1,190 @@
+import random
+import threading
+import time
+
+# Peer scoring and upload slot management.
+#
+# PeerScores keeps moving averages of how each remote peer performs when
+# we download from it (throughput, request latency and failure rate), so
+# the download engine can send more requests to fast, reliable peers.
+#
+# Choker decides which peers our /chunk endpoint serves. At most
+# UPLOAD_SLOTS interested peers are unchoked at a time: the ones that
+# upload to us fastest (tit-for-tat), or while we have nothing to get from
+# them, the ones that take our data fastest. One more optimistic slot
+# rotates through the other peers so newcomers get a chance to prove
+# themselves. Choked peers are told to come back later.
+
+# Bad chunks (failed hash checks) after which a peer is banned for good
+MAX_CORRUPT_CHUNKS = 2
+
+# Weight of the newest sample in the moving averages
+EWMA_ALPHA = 0.3
+# Throughput assumed for peers we haven't measured yet (bytes/second), high
+# enough that new peers get tried
+DEFAULT_THROUGHPUT = 4 * 1024 * 1024
+
+# Regular unchoke slots
+UPLOAD_SLOTS = 4
+# Seconds between recomputing which peers are unchoked
+CHOKE_INTERVAL = 10
+# Recomputations between rotations of the optimistic unchoke
+OPTIMISTIC_EVERY = 3
+# Seconds after its last request that a peer stops counting as interested
+INTEREST_TIMEOUT = 30
+
+
+def ewma(old, sample):
+    """Fold a sample into a moving average (None means no average yet)"""
+    return sample if old is None else old + EWMA_ALPHA * (sample - old)
+
+
+class PeerScores:
+    """Moving averages of download performance per remote peer"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # peer_id -> {"throughput", "latency", "failure_rate", "bytes", "requests", "corrupt"}
+        self.peers = {}
+
+    def _entry(self, peer_id):
+        return self.peers.setdefault(peer_id, {
+            "throughput": None,
+            "latency": None,
+            "failure_rate": 0.0,
+            "bytes": 0,
+            "requests": 0,
+            "corrupt": 0
+        })
+
+    def record_success(self, peer_id, nbytes, seconds):
+        """A request to a peer returned ``nbytes`` in ``seconds``"""
+        with self.lock:
+            entry = self._entry(peer_id)
+            entry["throughput"] = ewma(entry["throughput"], nbytes / max(seconds, 1e-6))
+            entry["latency"] = ewma(entry["latency"], seconds)
+            entry["failure_rate"] = ewma(entry["failure_rate"], 0.0)
+            entry["bytes"] += nbytes
+            entry["requests"] += 1
+
+    def record_failure(self, peer_id):
+        """A request to a peer failed"""
+        with self.lock:
+            entry = self._entry(peer_id)
+            entry["failure_rate"] = ewma(entry["failure_rate"], 1.0)
+            entry["requests"] += 1
+
+    def record_corrupt(self, peer_id):
+        """A peer sent a chunk that failed hash verification"""
+        with self.lock:
+            entry = self._entry(peer_id)
+            entry["failure_rate"] = ewma(entry["failure_rate"], 1.0)
+            entry["corrupt"] += 1
+
+    def is_banned(self, peer_id):
+        """Whether a peer sent too much corrupt data to be asked again"""
+        with self.lock:
+            entry = self.peers.get(peer_id)
+            return entry is not None and entry["corrupt"] >= MAX_CORRUPT_CHUNKS
+
+    def throughput(self, peer_id):
+        """Measured download rate from a peer in bytes/second, 0 if never measured"""
+        with self.lock:
+            entry = self.peers.get(peer_id)
+            return (entry["throughput"] or 0) if entry else 0
+
+    def score(self, peer_id):
+        """Expected useful bytes/second from a peer; unmeasured peers get the benefit of the doubt"""
+        with self.lock:
+            entry = self.peers.get(peer_id)
+            if entry is None or entry["throughput"] is None:
+                throughput = DEFAULT_THROUGHPUT
+                failure_rate = entry["failure_rate"] if entry else 0.0
+            else:
+                throughput = entry["throughput"]
+                failure_rate = entry["failure_rate"]
+            return throughput * (1 - failure_rate)
+
+    def stats(self):
+        """Snapshot of every peer's averages"""
+        with self.lock:
+            return {peer_id: dict(entry) for peer_id, entry in self.peers.items()}
+
+
+class Choker:
+    """
+    Choke/unchoke upload slots for the chunk server. ``download_rate(peer_id)``
+    tells how fast a peer uploads to us, for reciprocation.
+    """
+
+    def __init__(self, download_rate, slots=UPLOAD_SLOTS):
+        self.download_rate = download_rate
+        self.slots = slots
+        self.lock = threading.Lock()
+        # peer_id -> time of its last request
+        self.interested = {}
+        # peer_id -> bytes we sent it since the last rechoke
+        self.uploaded = {}
+        # peer_id -> bytes/second we sent it over the last interval
+        self.upload_rates = {}
+        self.unchoked = set()
+        self.optimistic = None
+        self.last_rechoke = time.time()
+        self.rechokes = 0
+
+    def request(self, peer_id):
+        """A peer asks for a chunk; True if it may have it now"""
+        with self.lock:
+            now = time.time()
+            self.interested[peer_id] = now
+            if now - self.last_rechoke >= CHOKE_INTERVAL:
+                self._rechoke(now)
+            if peer_id in self.unchoked or peer_id == self.optimistic:
+                return True
+            if len(self.unchoked) < self.slots:
+                # Free slot: no need to wait for the next rechoke
+                self.unchoked.add(peer_id)
+                return True
+            return False
+
+    def record_upload(self, peer_id, nbytes):
+        """We sent a peer ``nbytes``"""
+        with self.lock:
+            self.uploaded[peer_id] = self.uploaded.get(peer_id, 0) + nbytes
+
+    def retry_after(self):
+        """Seconds until choked peers may have a chance again"""
+        with self.lock:
+            return max(1, int(self.last_rechoke + CHOKE_INTERVAL - time.time()) + 1)
+
+    def _rechoke(self, now):
+        elapsed = max(now - self.last_rechoke, 1e-6)
+        self.upload_rates = {peer_id: nbytes / elapsed for peer_id, nbytes in self.uploaded.items()}
+        self.uploaded = {}
+        self.last_rechoke = now
+
+        for peer_id in [p for p, last in self.interested.items() if now - last > INTEREST_TIMEOUT]:
+            del self.interested[peer_id]
+
+        # Reciprocate peers that upload to us, then favor those that take our data fastest
+        ranked = sorted(
+            self.interested,
+            key=lambda p: (self.download_rate(p), self.upload_rates.get(p, 0)),
+            reverse=True
+        )
+        self.unchoked = set(ranked[:self.slots])
+
+        if self.rechokes % OPTIMISTIC_EVERY == 0 or self.optimistic not in self.interested:
+            choked = ranked[self.slots:]
+            self.optimistic = random.choice(choked) if choked else None
+        self.rechokes += 1
+
+    def stats(self):
+        """Current slot assignment and upload rates"""
+        with self.lock:
+            return {
+                "unchoked": sorted(self.unchoked),
+                "optimistic": self.optimistic,
+                "interested": len(self.interested),
+                "upload_rates": dict(self.upload_rates)
+            }
@@ -0,0 +1,174 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bitfield
+
+# Destination file of a download. The file is preallocated at its final
+# size and every chunk is written at its own offset with os.pwrite as it
+# arrives, so there is no merge step and chunks already on disk can be
+# served to other peers right away. Which chunks are on disk is kept in a
+# sidecar bitfield file next to it (<path>.bitfield), one byte rewritten
+# per chunk; the sidecar is removed once the download is complete.
+#
+# What the download is (file ID, manifest, destination) is kept in a
+# second sidecar, the journal (<path>.resume), written once when the
+# download starts. Together the two let a restarted peer find its
+# unfinished downloads in DOWNLOAD_DIR and pick them up where they were.
+# Chunk data is written before its bit, and marked chunks are checked
+# against the manifest on resume, so a crash can at worst lose a chunk,
+# never keep a corrupt one.
+
+SIDECAR_SUFFIX = ".bitfield"
+JOURNAL_SUFFIX = ".resume"
+
+
+def preallocate(fd, size):
+    """Give an open file its final size, reserving the blocks where the filesystem allows"""
+    os.ftruncate(fd, size)
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            # Not supported here (e.g. some network filesystems); stay sparse
+            pass
+
+
+def save_journal(path, journal):
+    """Atomically write the journal of the download into ``path``"""
+    journal_path = path + JOURNAL_SUFFIX
+    tmp_path = journal_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(journal, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, journal_path)
+
+
+def load_journal(path):
+    """The journal of the download into ``path``, or None if there is none or it is unreadable"""
+    try:
+        with open(path + JOURNAL_SUFFIX) as f:
+            journal = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return journal if isinstance(journal, dict) else None
+
+
+def find_journals(directory):
+    """Destination paths of the unfinished downloads in a directory"""
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return []
+    return [
+        os.path.join(directory, name[:-len(JOURNAL_SUFFIX)])
+        for name in names if name.endswith(JOURNAL_SUFFIX)
+    ]
+
+
+class PieceFile:
+    """
+    A download's destination file plus its on-disk completion bitfield.
+    With ``resume`` the bitfield left by an earlier run is kept (if it fits
+    the file), otherwise the download starts from nothing.
+    """
+
+    def __init__(self, path, size, piece_length, resume=False):
+        self.path = path
+        self.size = size
+        self.piece_length = piece_length
+        self.num_pieces = (size + piece_length - 1) // piece_length
+        self.sidecar_path = path + SIDECAR_SUFFIX
+        self.lock = threading.Lock()
+        # Notified whenever a piece lands, for readers waiting on it
+        self.arrived = threading.Condition(self.lock)
+        self.bits = bitfield.empty(self.num_pieces)
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        preallocate(self.fd, size)
+        self.sidecar_fd = os.open(self.sidecar_path, os.O_RDWR | os.O_CREAT, 0o644)
+        if resume:
+            saved = os.pread(self.sidecar_fd, len(self.bits) + 1, 0)
+            if len(saved) == len(self.bits):
+                self.bits = bitfield.from_indices(bitfield.to_indices(saved, self.num_pieces), self.num_pieces)
+        os.ftruncate(self.sidecar_fd, len(self.bits))
+        os.pwrite(self.sidecar_fd, bytes(self.bits), 0)
+
+    def piece_size(self, index):
+        """Length of a piece; the last one may be short"""
+        return min(self.piece_length, self.size - index * self.piece_length)
+
+    def has(self, index):
+        """Whether a piece is on disk"""
+        return bitfield.has(self.bits, index)
+
+    def count(self):
+        """Number of pieces on disk"""
+        return bitfield.count(self.bits)
+
+    def is_complete(self):
+        return bitfield.is_complete(self.bits, self.num_pieces)
+
+    def write(self, index, data):
+        """Write a piece at its offset and mark it done"""
+        if not 0 <= index < self.num_pieces:
+            raise ValueError(f"Piece {index} out of range")
+        if len(data) != self.piece_size(index):
+            raise ValueError(f"Piece {index} is {len(data)} bytes, expected {self.piece_size(index)}")
+
+        view = memoryview(data)
+        offset = index * self.piece_length
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+
+        with self.lock:
+            bitfield.set_bit(self.bits, index)
+            byte = index >> 3
+            os.pwrite(self.sidecar_fd, self.bits[byte:byte + 1], byte)
+            self.arrived.notify_all()
+
+    def wait_for(self, index, timeout):
+        """Wait until a piece is on disk; False if it didn't land within ``timeout`` seconds"""
+        with self.arrived:
+            return self.arrived.wait_for(lambda: self.has(index), timeout)
+
+    def read(self, index):
+        """Read a piece back from disk"""
+        return os.pread(self.fd, self.piece_size(index), index * self.piece_length)
+
+    def verify(self, check, workers=None):
+        """
+        Re-read every piece marked as done and unmark those for which
+        ``check(index, data)`` fails, e.g. because a crash hit between
+        writing a piece and its bit. Returns the indices that were dropped.
+        """
+        marked = [index for index in bitfield.iter_set(self.bits) if index < self.num_pieces]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(lambda index: check(index, self.read(index)), marked)
+            dropped = [index for index, ok in zip(marked, results) if not ok]
+
+        if dropped:
+            with self.lock:
+                self.bits = bitfield.from_indices(set(marked) - set(dropped), self.num_pieces)
+                os.pwrite(self.sidecar_fd, bytes(self.bits), 0)
+        return dropped
+
+    def close(self):
+        """Close the file, keeping the sidecar so the download can be picked up again"""
+        os.close(self.fd)
+        os.close(self.sidecar_fd)
+
+    def finish(self):
+        """Close the completed file and drop its sidecar and journal"""
+        self.close()
+        # The journal goes first: without it the download isn't resumed,
+        # while a journal left without its sidecar would fetch it all again
+        try:
+            os.remove(self.path + JOURNAL_SUFFIX)
+        except FileNotFoundError:
+            pass
+        os.remove(self.sidecar_path)
@@ -0,0 +1,150 @@
+import random
+
+import bitfield
+
+# Piece pickers decide in which order a download asks for its missing
+# chunks. The download engine walks ``picker.order(pending)`` and requests
+# the first chunks some idle peer can serve.
+#
+#   rarest      chunks held by the fewest peers first, so scarce chunks
+#               spread before their holders leave (the default)
+#   random      a few random chunks first, to have something to upload
+#               quickly, then rarest first
+#   sequential  in file order, e.g. to start using a file early
+#   streaming   a window of chunks ahead of where the file is being read
+#               first, in file order, then the rest rarest first
+
+DEFAULT_STRATEGY = "rarest"
+# Chunks the random-first strategy fetches before switching to rarest first
+RANDOM_FIRST_PIECES = 4
+# Chunks ahead of the read position that a streaming download fetches first
+STREAM_WINDOW = 8
+
+
+class RarestFirstPicker:
+    """
+    Order chunks by how many peers hold them, rarest first, breaking ties
+    randomly so that leechers don't all chase the same chunk. Rarity comes
+    from the swarm-wide counts of the tracker's /file/<id>/availability
+    when available, otherwise from the chunk lists of the peers we know.
+    """
+
+    def __init__(self, total_chunks, have=()):
+        self.total_chunks = total_chunks
+        # Chunks we still need; done chunks are pruned from the ranking lazily
+        self.wanted = set(range(total_chunks)) - set(have)
+        self.counts = [0] * total_chunks
+        self.ranking = []
+        self._rank()
+
+    def update(self, peers, swarm_counts=None):
+        """
+        Recount chunk availability from a ``{peer_id: peer_info}`` dict in
+        the tracker's compact form, or take ``swarm_counts`` (one replica
+        count per chunk, seeders included) when given
+        """
+        if swarm_counts is not None and len(swarm_counts) == self.total_chunks:
+            self.counts = list(swarm_counts)
+        else:
+            counts = [0] * self.total_chunks
+            seeders = 0
+            for peer_info in peers.values():
+                if peer_info.get("seeder"):
+                    seeders += 1
+                else:
+                    for index in bitfield.iter_set(peer_info.get("bitfield") or b""):
+                        if index < self.total_chunks:
+                            counts[index] += 1
+            self.counts = [count + seeders for count in counts]
+        self._rank()
+
+    def completed(self, index):
+        """A chunk was stored and is no longer wanted"""
+        self.wanted.discard(index)
+
+    def _key(self, index):
+        # Chunks nobody is known to have go last
+        return self.counts[index] or float("inf")
+
+    def _rank(self):
+        indices = list(self.wanted)
+        random.shuffle(indices)
+        indices.sort(key=self._key)
+        self.ranking = indices
+
+    def order(self, pending):
+        """Yield the ``pending`` chunks in the order they should be requested"""
+        if len(self.ranking) > 2 * len(self.wanted) + 64:
+            self.ranking = [index for index in self.ranking if index in self.wanted]
+        for index in self.ranking:
+            if index in pending:
+                yield index
+
+
+class RandomFirstPicker(RarestFirstPicker):
+    """Pick the first few chunks at random, then rarest first"""
+
+    def __init__(self, total_chunks, have=()):
+        super().__init__(total_chunks, have)
+        self.fetched = total_chunks - len(self.wanted)
+
+    def completed(self, index):
+        if index in self.wanted:
+            self.fetched += 1
+        super().completed(index)
+
+    def order(self, pending):
+        if self.fetched >= RANDOM_FIRST_PIECES:
+            return super().order(pending)
+        indices = list(pending)
+        random.shuffle(indices)
+        return iter(indices)
+
+
+class SequentialPicker(RarestFirstPicker):
+    """Pick chunks in file order"""
+
+    def _rank(self):
+        self.ranking = sorted(self.wanted)
+
+
+class StreamingPicker(RarestFirstPicker):
+    """
+    Pick the ``window`` chunks from the read position on first, in file
+    order, so a file can be used while it downloads; the rest follow rarest
+    first. ``seek(index)`` moves the window as the reader moves.
+    """
+
+    def __init__(self, total_chunks, have=(), window=STREAM_WINDOW):
+        super().__init__(total_chunks, have)
+        self.window = window
+        self.position = 0
+
+    def seek(self, index):
+        """The reader is now at chunk ``index``"""
+        self.position = max(0, min(index, self.total_chunks))
+
+    def order(self, pending):
+        start = self.position
+        stop = min(start + self.window, self.total_chunks)
+        for index in range(start, stop):
+            if index in pending:
+                yield index
+        for index in super().order(pending):
+            if not start <= index < stop:
+                yield index
+
+
+STRATEGIES = {
+    "rarest": RarestFirstPicker,
+    "random": RandomFirstPicker,
+    "sequential": SequentialPicker,
+    "streaming": StreamingPicker,
+}
+
+
+def create(strategy, total_chunks, have=()):
+    """Make the picker for a strategy name"""
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown piece strategy: {strategy}")
+    return STRATEGIES[strategy](total_chunks, have)
@@ -1,7 +1,10 @@
 document.addEventListener('DOMContentLoaded', function() {
     // Constants and configuration
     const TRACKER_URL = 'http://localhost:5000';
-    const CHUNK_SIZE = 1024 * 1024; // 1MB chunks (should match server setting)
+    // Piece length bounds, chosen per file like manifest.piece_length_for
+    const MIN_PIECE_LENGTH = 64 * 1024;
+    const MAX_PIECE_LENGTH = 16 * 1024 * 1024;
+    const MAX_PIECES = 2048;
     let currentPeerId = generatePeerId();
     let peerPort = 8000; // Default port, could be made configurable
     let sharedFiles = {};
@@ -182,23 +185,32 @@ document.addEventListener('DOMContentLoaded', function() {
         const formData = new FormData();
         formData.append('file', file);
         
-        // First, generate a file ID
-        fetch(`${TRACKER_URL}/generate_file_id`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                filename: file.name,
-                size: file.size
-            })
+        let manifest;
+        const pieceLength = pieceLengthFor(file.size);
+        
+        // First, hash the chunks and get the content-addressed file ID
+        hashFile(file, pieceLength)
+        .then(pieces => {
+            manifest = {
+                size: file.size,
+                piece_length: pieceLength,
+                pieces: pieces
+            };
+            return fetch(`${TRACKER_URL}/generate_file_id`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify(manifest)
+            });
         })
         .then(response => response.json())
         .then(data => {
             const fileId = data.file_id;
+            manifest.root = data.root;
             
             // Split the file into chunks
-            splitFile(file, fileId)
+            splitFile(file, fileId, pieceLength)
                 .then(fileInfo => {
                     // Announce file to tracker
                     return fetch(`${TRACKER_URL}/announce`, {
@@ -212,8 +224,9 @@ document.addEventListener('DOMContentLoaded', function() {
                             port: peerPort,
                             filename: file.name,
                             size: file.size,
-                            chunks: fileInfo.numChunks,
-                            chunks: Array.from(Array(fileInfo.numChunks).keys()) // Array of chunk indices
+                            num_chunks: fileInfo.numChunks,
+                            manifest: manifest,
+                            seeder: true // We have every chunk of a file we share
                         })
                     });
                 })
@@ -223,7 +236,8 @@ document.addEventListener('DOMContentLoaded', function() {
                     sharedFiles[fileId] = {
                         filename: file.name,
                         size: file.size,
-                        chunks: Array.from(Array(Math.ceil(file.size / CHUNK_SIZE)).keys()),
+                        chunks: Array.from(Array(Math.ceil(file.size / pieceLength)).keys()),
+                        pieceLength: pieceLength,
                         path: URL.createObjectURL(file) // Store file as blob URL
                     };
                     
@@ -252,15 +266,55 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    // Smallest power-of-two piece length that keeps the file within
+    // MAX_PIECES pieces
+    function pieceLengthFor(size) {
+        let pieceLength = MIN_PIECE_LENGTH;
+        while (pieceLength < MAX_PIECE_LENGTH && size > pieceLength * MAX_PIECES) {
+            pieceLength *= 2;
+        }
+        return pieceLength;
+    }
+    
+    // Hash every chunk with SHA-256 and return the concatenated digests in
+    // base64, the "pieces" of the file's manifest. A few chunks are read
+    // and hashed at a time so large files aren't loaded all at once.
+    function hashFile(file, pieceLength) {
+        const numChunks = Math.ceil(file.size / pieceLength);
+        const digests = new Uint8Array(numChunks * 32);
+        const HASH_BATCH = 8;
+        let done = Promise.resolve();
+        
+        for (let start = 0; start < numChunks; start += HASH_BATCH) {
+            done = done.then(() => {
+                const batch = [];
+                for (let i = start; i < Math.min(numChunks, start + HASH_BATCH); i++) {
+                    batch.push(
+                        file.slice(i * pieceLength, (i + 1) * pieceLength).arrayBuffer()
+                            .then(buffer => crypto.subtle.digest('SHA-256', buffer))
+                            .then(digest => digests.set(new Uint8Array(digest), i * 32))
+                    );
+                }
+                return Promise.all(batch);
+            });
+        }
+        
+        return done.then(() => {
+            let binary = '';
+            digests.forEach(byte => { binary += String.fromCharCode(byte); });
+            return btoa(binary);
+        });
+    }
+    
     // Split file into chunks
-    function splitFile(file, fileId) {
+    function splitFile(file, fileId, pieceLength) {
         return new Promise((resolve, reject) => {
-            const numChunks = Math.ceil(file.size / CHUNK_SIZE);
+            const numChunks = Math.ceil(file.size / pieceLength);
             const chunkInfos = [];
             
             for (let i = 0; i < numChunks; i++) {
-                const start = i * CHUNK_SIZE;
-                const end = Math.min(file.size, start + CHUNK_SIZE);
+                const start = i * pieceLength;
+                const end = Math.min(file.size, start + pieceLength);
                 const chunk = file.slice(start, end);
                 
                 // In a real implementation, you would save these chunks to storage
@@ -418,7 +472,7 @@ document.addEventListener('DOMContentLoaded', function() {
                         peer_id: currentPeerId,
                         file_id: fileId,
                         port: peerPort,
-                        chunks: fileInfo.chunks
+                        seeder: true
                     })
                 })
                 .catch(error => {
@@ -0,0 +1,318 @@
+import base64
+import sys
+
+import bitfield
+import manifest
+
+# Request handling shared by the Flask tracker (app.py) and the asyncio
+# tracker (tracker_asgi.py). Every handler takes the TrackerStore and the
+# already-parsed request data, and returns a (payload, status code) pair.
+
+# Number of peers returned by an announce unless the peer asks for another
+# amount with "numwant", and the most it may ask for
+DEFAULT_NUMWANT = 50
+MAX_NUMWANT = 200
+# Most files a peer may announce in one /announce/batch request
+MAX_BATCH_FILES = 1000
+# Most chunks a file may have
+MAX_CHUNKS = 1 << 20
+
+def parse_availability(data, num_chunks):
+    """
+    Read which chunks an announcing peer has. Accepts the compact form
+    (a "seeder" flag or a base64 "bitfield") as well as a plain "chunks"
+    index list. Returns a (seeder, bits) pair; raises ValueError if the
+    availability is malformed.
+    """
+    if data.get('seeder'):
+        return True, None
+    
+    if 'bitfield' in data:
+        if not isinstance(data['bitfield'], str):
+            raise ValueError("bitfield must be a base64 string")
+        bits = bitfield.decode(data['bitfield'], num_chunks)
+    else:
+        chunks = data.get('chunks', [])
+        if not isinstance(chunks, list):
+            # Older peers send the chunk count here when sharing a whole file
+            return True, None
+        if not all(is_int(index) and 0 <= index < num_chunks for index in chunks):
+            raise ValueError(f"chunk indices must be integers from 0 to {num_chunks - 1}")
+        bits = bitfield.from_indices(chunks, num_chunks)
+    
+    if bitfield.is_complete(bits, num_chunks):
+        return True, None
+    return False, bits
+
+def format_peer(peer_info, num_chunks, compact):
+    """Describe a peer for a response, as a bitfield or as a chunk list"""
+    entry = {
+        "ip": peer_info["ip"],
+        "port": peer_info["port"]
+    }
+    if compact:
+        if peer_info["seeder"]:
+            entry["seeder"] = True
+        else:
+            entry["bitfield"] = bitfield.encode(peer_info["bitfield"])
+    elif peer_info["seeder"]:
+        entry["chunks"] = list(range(num_chunks))
+    else:
+        entry["chunks"] = bitfield.to_indices(peer_info["bitfield"], num_chunks)
+    return entry
+
+def is_int(value):
+    """Whether a JSON value is an integer (booleans don't count)"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def is_flag_set(value):
+    """Interpret a query-string flag such as ?compact=1"""
+    return value not in (None, '0', '', 'false')
+
+def announce(store, data, ip):
+    """
+    Apply one peer's announce for one file and build the response.
+    Returns a (payload, status code) pair.
+    
+    A full announce describes every chunk the peer has. A delta announce
+    sends only new chunk indices in "have" together with "seq", which must
+    be one more than the previous announce's; if it isn't, the tracker
+    answers 409 and the peer falls back to a full announce.
+    
+    Full announces return up to "numwant" peers, preferring ones holding
+    chunks the announcing peer is missing.
+    """
+    if not isinstance(data, dict):
+        return {"error": "Missing required fields"}, 400
+    peer_id = data.get('peer_id')
+    file_id = data.get('file_id')
+    port = data.get('port')
+    compact = bool(data.get('compact'))
+    
+    if not peer_id or not file_id or not port:
+        return {"error": "Missing required fields"}, 400
+    if not isinstance(peer_id, str) or not isinstance(file_id, str):
+        return {"error": "Invalid peer_id or file_id"}, 400
+    if not is_int(port) or not 1 <= port <= 65535:
+        return {"error": "Invalid port"}, 400
+    
+    try:
+        numwant = max(0, min(int(data.get('numwant', DEFAULT_NUMWANT)), MAX_NUMWANT))
+    except (TypeError, ValueError):
+        return {"error": "Invalid numwant"}, 400
+    
+    # Initialize file entry if it doesn't exist
+    known = store.files.get(file_id)
+    if 'manifest' in data and ('filename' in data if known is None else "manifest" not in known):
+        # Content-addressed file: the ID must come from the manifest's root
+        try:
+            file_manifest = manifest.from_json(data['manifest'])
+        except ValueError as e:
+            return {"error": f"Invalid manifest: {e}"}, 400
+        if manifest.file_id(file_manifest["root"]) != file_id:
+            return {"error": "File ID does not match the manifest"}, 400
+        size, num_chunks = file_manifest["size"], manifest.num_pieces(file_manifest)
+        if num_chunks > MAX_CHUNKS:
+            return {"error": "Invalid number of chunks"}, 400
+        manifest_json = manifest.to_json(file_manifest)
+        if known is None:
+            store.add_file(file_id, data['filename'], size, num_chunks, manifest_json,
+                           file_manifest["piece_length"])
+        # Anyone may register an ID without a manifest; the manifest proves
+        # the content, so it overrides whatever size and chunks were claimed
+        store.attach_manifest(file_id, manifest_json, size, num_chunks, file_manifest["piece_length"])
+    elif 'manifest' not in data and 'filename' in data and 'size' in data and ('num_chunks' in data or 'chunks' in data):
+        size = data['size']
+        num_chunks = data.get('num_chunks', data.get('chunks'))
+        if isinstance(num_chunks, list):
+            num_chunks = len(num_chunks)
+        piece_length = data.get('piece_length', manifest.DEFAULT_PIECE_LENGTH)
+        if not is_int(piece_length) or not 0 < piece_length <= manifest.MAX_PIECE_LENGTH:
+            return {"error": "Invalid piece length"}, 400
+        if not is_int(size) or size < 0:
+            return {"error": "Invalid size"}, 400
+        expected = (size + piece_length - 1) // piece_length
+        if not is_int(num_chunks) or num_chunks != expected or expected > MAX_CHUNKS:
+            return {"error": "Invalid number of chunks"}, 400
+        if not store.add_file(file_id, data['filename'], size, num_chunks, piece_length=piece_length):
+            known = store.files[file_id]
+            if (size, num_chunks, piece_length) != (known["size"], known["chunks"], known["piece_length"]):
+                return {"error": "File ID is already registered with different contents"}, 409
+    
+    file_info = store.files.get(file_id)
+    if file_info is None:
+        return {"error": "File not found and insufficient information to create"}, 404
+    total_chunks = file_info["chunks"]
+    seq = data.get('seq', 0)
+    if not is_int(seq) or seq < 0:
+        return {"error": "Invalid seq"}, 400
+    
+    # A delta announce only carries the chunks gained since the last one
+    if 'have' in data:
+        have = data['have']
+        if not isinstance(have, list) or not all(is_int(i) and 0 <= i < total_chunks for i in have):
+            return {"error": "Invalid chunk indices"}, 400
+        if not store.apply_have(file_id, peer_id, have, seq):
+            return {"error": "Sequence gap, full announce required", "resync": True}, 409
+        return {"file_id": file_id, "seq": seq}, 200
+    
+    try:
+        seeder, bits = parse_availability(data, total_chunks)
+    except ValueError as e:
+        return {"error": f"Invalid availability: {e}"}, 400
+    
+    # Update peer information
+    try:
+        if not store.update_peer(file_id, peer_id, ip, port, seeder, bits, seq):
+            return {"error": "File not found"}, 404
+    except ValueError:
+        # A manifest changed the file's chunk count while this was parsed
+        return {"error": "File changed, announce again", "resync": True}, 409
+    
+    # Return a bounded sample of the peers that have this file
+    store.expire()
+    with store.lock:
+        # Re-read under the lock, in case a manifest has changed it
+        total_chunks = file_info["chunks"]
+        peers_with_file = {}
+        # The requesting peer is left out of the response
+        for pid, peer_info in store.sample_peers(file_id, numwant, peer_id, seeder, bits):
+            peers_with_file[pid] = format_peer(peer_info, total_chunks, compact)
+    
+    return {
+        "file_id": file_id,
+        "peers": peers_with_file,
+        "total_chunks": total_chunks
+    }, 200
+
+def announce_batch(store, data, ip):
+    """
+    Announce many files in one request. The body carries "peer_id" and
+    "port" (plus optional "compact" and "numwant") once, and a "files"
+    list with the per-file fields of a normal announce. Each result holds
+    what an announce would have returned for that file plus its "status".
+    """
+    files = data.get('files') if isinstance(data, dict) else None
+    
+    if not isinstance(files, list):
+        return {"error": "Missing required fields"}, 400
+    if len(files) > MAX_BATCH_FILES:
+        return {"error": f"At most {MAX_BATCH_FILES} files per batch"}, 400
+    
+    shared = {key: data[key] for key in ('peer_id', 'port', 'compact', 'numwant') if key in data}
+    results = []
+    for entry in files:
+        if not isinstance(entry, dict):
+            results.append({"error": "Invalid entry", "status": 400})
+            continue
+        payload, status = announce(store, {**shared, **entry}, ip)
+        payload["status"] = status
+        results.append(payload)
+    
+    return {"results": results}, 200
+
+def list_files(store):
+    """
+    List all available files in the tracker
+    """
+    files = {}
+    
+    # Stale peers are evicted by the store, so every remaining peer is active
+    store.expire()
+    with store.lock:
+        for file_id, file_info in store.files.items():
+            files[file_id] = {
+                "filename": file_info["filename"],
+                "size": file_info["size"],
+                "chunks": file_info["chunks"],
+                "piece_length": file_info["piece_length"],
+                "active_peers": len(file_info["peers"])
+            }
+    
+    return {"files": files}, 200
+
+def get_file_info(store, file_id, compact=False, numwant=None):
+    """
+    Get detailed information about a specific file. With ``compact`` peer
+    availability is given as bitfields instead of chunk lists, and with
+    ``numwant`` only a sample of at most that many peers is returned.
+    """
+    store.expire()
+    with store.lock:
+        if file_id not in store.files:
+            return {"error": "File not found"}, 404
+        
+        file_info = store.files[file_id]
+        active_peers = {}
+        
+        if numwant is None:
+            peers = file_info["peers"].items()
+        else:
+            peers = store.sample_peers(file_id, max(0, min(numwant, MAX_NUMWANT)))
+        
+        for peer_id, peer_info in peers:
+            active_peers[peer_id] = format_peer(peer_info, file_info["chunks"], compact)
+        
+        response = {
+            "file_id": file_id,
+            "filename": file_info["filename"],
+            "size": file_info["size"],
+            "chunks": file_info["chunks"],
+            "piece_length": file_info["piece_length"],
+            "peers": active_peers
+        }
+        if "manifest" in file_info:
+            response["root"] = file_info["manifest"]["root"]
+        return response, 200
+
+def get_file_manifest(store, file_id):
+    """
+    Get the piece-hash manifest of a file, for verifying downloaded chunks
+    """
+    with store.lock:
+        if file_id not in store.files:
+            return {"error": "File not found"}, 404
+        file_manifest = store.files[file_id].get("manifest")
+        if file_manifest is None:
+            return {"error": "No manifest for this file"}, 404
+        return dict(file_manifest, file_id=file_id), 200
+
+def get_file_availability(store, file_id, compact=False):
+    """
+    Get how many live peers hold each chunk of a file, for rarest-first
+    piece picking. "counts" excludes seeders, which hold every chunk, so
+    the replica count of chunk i is counts[i] + seeders. With ``compact``
+    counts is base64 of little-endian unsigned 32-bit integers.
+    """
+    store.expire()
+    availability = store.chunk_availability(file_id)
+    if availability is None:
+        return {"error": "File not found"}, 404
+    
+    seeders, counts = availability
+    num_chunks = len(counts)
+    if compact:
+        if sys.byteorder != 'little':
+            counts.byteswap()
+        counts = base64.b64encode(counts.tobytes()).decode('ascii')
+    else:
+        counts = counts.tolist()
+    
+    return {
+        "file_id": file_id,
+        "chunks": num_chunks,
+        "seeders": seeders,
+        "counts": counts
+    }, 200
+
+def generate_file_id(data):
+    """
+    Derive the content-addressed file ID from a file's manifest: its
+    "size", "piece_length" and base64 "pieces" hashes
+    """
+    try:
+        file_manifest = manifest.from_json(data)
+    except ValueError as e:
+        return {"error": f"Invalid manifest: {e}"}, 400
+    
+    return {"file_id": manifest.file_id(file_manifest["root"]), "root": file_manifest["root"]}, 200
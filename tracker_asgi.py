@@ -0,0 +1,153 @@
+import argparse
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+import tracker_api
+from tracker_store import TrackerStore
+
+# Asyncio tracker mode. Serves the same API as app.py, but as an ASGI
+# application so it can run on an event-loop server such as uvicorn
+# instead of the Flask development server:
+#
+#   python tracker_asgi.py --port 5000 --backlog 4096
+#
+# Request handlers only touch the in-memory TrackerStore and never block
+# on disk; the store's background thread writes the log and snapshots.
+
+# Largest request body accepted (a batch announce of many bitfields)
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"GET, POST, OPTIONS"),
+    (b"access-control-allow-headers", b"Content-Type"),
+]
+
+
+class TrackerApp:
+    """ASGI application serving the tracker API from a TrackerStore"""
+
+    def __init__(self, store, trust_proxy=False):
+        self.store = store
+        self.trust_proxy = trust_proxy
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            payload, status = await self._handle(scope, receive)
+            await self._respond(send, payload, status)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                # Flushing the log may block, keep it off the event loop
+                await asyncio.get_running_loop().run_in_executor(None, self.store.close)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _handle(self, scope, receive):
+        """Route a request to the shared handlers in tracker_api"""
+        method = scope["method"]
+        parts = scope["path"].strip("/").split("/")
+        args = {key: values[-1] for key, values in parse_qs(scope["query_string"].decode("latin-1")).items()}
+        ip = scope["client"][0] if scope.get("client") else None
+        if self.trust_proxy:
+            # Behind tracker_router.py the peer's address is forwarded
+            for name, value in scope["headers"]:
+                if name == b"x-forwarded-for":
+                    ip = value.decode("latin-1").split(",")[0].strip()
+
+        if method == "OPTIONS":
+            # CORS preflight from the browser client
+            return None, 204
+
+        if method == "POST":
+            try:
+                data = json.loads(await self._read_body(receive))
+            except ValueError as e:
+                return {"error": f"Invalid request body: {e}"}, 400
+            if not isinstance(data, dict):
+                return {"error": "Request body must be a JSON object"}, 400
+
+            if parts == ["announce"]:
+                return tracker_api.announce(self.store, data, ip)
+            if parts == ["announce", "batch"]:
+                return tracker_api.announce_batch(self.store, data, ip)
+            if parts == ["generate_file_id"]:
+                return tracker_api.generate_file_id(data)
+
+        elif method == "GET":
+            compact = tracker_api.is_flag_set(args.get("compact"))
+            if parts == ["list"]:
+                return tracker_api.list_files(self.store)
+            if len(parts) == 2 and parts[0] == "file":
+                try:
+                    numwant = int(args["numwant"]) if "numwant" in args else None
+                except ValueError:
+                    numwant = None
+                return tracker_api.get_file_info(self.store, parts[1], compact=compact, numwant=numwant)
+            if len(parts) == 3 and parts[0] == "file" and parts[2] == "availability":
+                return tracker_api.get_file_availability(self.store, parts[1], compact=compact)
+            if len(parts) == 3 and parts[0] == "file" and parts[2] == "manifest":
+                return tracker_api.get_file_manifest(self.store, parts[1])
+
+        return {"error": "Not found"}, 404
+
+    async def _read_body(self, receive):
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > MAX_BODY_SIZE:
+                raise ValueError("body too large")
+            if not message.get("more_body"):
+                return bytes(body)
+
+    async def _respond(self, send, payload, status):
+        body = b"" if payload is None else json.dumps(payload, separators=(",", ":")).encode()
+        headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ] + CORS_HEADERS
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mini-Torrent tracker (asyncio mode)')
+    parser.add_argument('--host', default='0.0.0.0', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='Port to listen on')
+    parser.add_argument('--db', default='tracker_db.json', help='Snapshot file; the change log sits next to it')
+    parser.add_argument('--backlog', type=int, default=4096, help='Listen backlog for pending connections')
+    parser.add_argument('--limit-concurrency', type=int, default=None,
+                        help='Answer 503 once this many connections are open')
+    parser.add_argument('--keep-alive', type=int, default=30, help='Seconds to keep idle connections open')
+    parser.add_argument('--trust-proxy', action='store_true',
+                        help='Take peer addresses from X-Forwarded-For (when running behind tracker_router.py)')
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        parser.exit(1, "The asyncio tracker needs uvicorn: pip install 'uvicorn[standard]'\n")
+
+    app = TrackerApp(TrackerStore(args.db), trust_proxy=args.trust_proxy)
+    uvicorn.run(
+        app,
+        host=args.host,
+        port=args.port,
+        backlog=args.backlog,
+        limit_concurrency=args.limit_concurrency,
+        timeout_keep_alive=args.keep_alive,
+        access_log=False,
+        log_level="warning"
+    )
+
+
+if __name__ == "__main__":
+    main()
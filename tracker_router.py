@@ -0,0 +1,287 @@
+from flask import Flask, request, jsonify, redirect, Response
+from flask_cors import CORS
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import atexit
+import bisect
+import hashlib
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import requests
+
+import tracker_api
+
+# Sharded tracker deployment. Each file_id is consistently hashed to one
+# tracker shard (an app.py or tracker_asgi.py process, on this machine or
+# another). This router sits in front of them and speaks the normal
+# tracker API, so peers only need the router's URL:
+#
+#   python tracker_router.py --spawn 4                  # 4 local shards on 5001-5004
+#   python tracker_router.py --shard http://a:5000 --shard http://b:5000
+#
+# Per-file requests are forwarded to (or, with --redirect, redirected to)
+# the owning shard; /list fans out to every shard and merges the results.
+# Redirected peers talk to the shards themselves, so spawned shards then
+# have to listen on an address peers can reach (--shard-host), and they
+# take peer addresses from the connection rather than X-Forwarded-For.
+
+app = Flask(__name__)
+CORS(app)
+
+logger = logging.getLogger("TrackerRouter")
+
+# Points each shard gets on the hash ring; more points spread files more evenly
+VNODES = 64
+# Seconds to wait for a shard to answer a forwarded request
+SHARD_TIMEOUT = 10
+
+
+class HashRing:
+    """Consistent hash ring mapping file IDs to shard URLs"""
+
+    def __init__(self, shards, vnodes=VNODES):
+        points = []
+        for shard in shards:
+            for i in range(vnodes):
+                points.append((self._hash(f"{shard}#{i}"), shard))
+        points.sort()
+        self._keys = [key for key, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+    def shard_for(self, file_id):
+        """The shard responsible for a file ID"""
+        index = bisect.bisect(self._keys, self._hash(file_id)) % len(self._keys)
+        return self._shards[index]
+
+
+shards = []
+ring = None
+# One keep-alive session per shard
+sessions = {}
+fanout = None
+redirect_mode = False
+
+
+def configure(shard_urls, use_redirects=False):
+    """Set the shards this router spreads files across"""
+    global shards, ring, fanout, redirect_mode
+    shards = [url.rstrip('/') for url in shard_urls]
+    ring = HashRing(shards)
+    sessions.clear()
+    for shard in shards:
+        sessions[shard] = requests.Session()
+    fanout = ThreadPoolExecutor(max_workers=max(4, len(shards)))
+    redirect_mode = use_redirects
+
+
+def forward(shard, method, path, **kwargs):
+    """Pass the current request on to a shard and relay its answer"""
+    headers = {"X-Forwarded-For": request.remote_addr}
+    try:
+        response = sessions[shard].request(method, shard + path, headers=headers, timeout=SHARD_TIMEOUT, **kwargs)
+    except requests.RequestException as e:
+        logger.error(f"Shard {shard} unavailable: {e}")
+        return jsonify({"error": "Tracker shard unavailable"}), 502
+    return Response(response.content, status=response.status_code, content_type=response.headers.get('Content-Type'))
+
+
+def route_to_owner(file_id, method, path, **kwargs):
+    """Forward or redirect a per-file request to the shard that owns the file"""
+    shard = ring.shard_for(file_id)
+    if redirect_mode:
+        # 307 keeps the method and body of POST requests
+        query = request.query_string.decode()
+        return redirect(shard + path + (f"?{query}" if query else ""), code=307)
+    return forward(shard, method, path, **kwargs)
+
+
+@app.route('/announce', methods=['POST'])
+def announce():
+    """
+    Send an announce to the shard that owns its file
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict) or not data.get('file_id') or not isinstance(data['file_id'], str):
+        return jsonify({"error": "Missing required fields"}), 400
+    return route_to_owner(data['file_id'], 'POST', '/announce', json=data)
+
+
+@app.route('/announce/batch', methods=['POST'])
+def announce_batch():
+    """
+    Split a batch announce by shard, send the parts in parallel and put the
+    results back in the order of the original batch
+    """
+    data = request.get_json(silent=True) or {}
+    files = data.get('files') if isinstance(data, dict) else None
+
+    if not isinstance(files, list):
+        return jsonify({"error": "Missing required fields"}), 400
+    if len(files) > tracker_api.MAX_BATCH_FILES:
+        return jsonify({"error": f"At most {tracker_api.MAX_BATCH_FILES} files per batch"}), 400
+
+    results = [None] * len(files)
+    parts = {}
+    for position, entry in enumerate(files):
+        if not isinstance(entry, dict) or not entry.get('file_id') or not isinstance(entry['file_id'], str):
+            results[position] = {"error": "Invalid entry", "status": 400}
+            continue
+        parts.setdefault(ring.shard_for(entry['file_id']), []).append(position)
+
+    shared = {key: value for key, value in data.items() if key != 'files'}
+    headers = {"X-Forwarded-For": request.remote_addr}
+
+    def send_part(shard, positions):
+        body = dict(shared, files=[files[position] for position in positions])
+        response = sessions[shard].post(shard + '/announce/batch', json=body, headers=headers, timeout=SHARD_TIMEOUT)
+        response.raise_for_status()
+        return response.json()["results"]
+
+    futures = {shard: fanout.submit(send_part, shard, positions) for shard, positions in parts.items()}
+    for shard, future in futures.items():
+        try:
+            part_results = future.result()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.error(f"Shard {shard} unavailable: {e}")
+            part_results = [{"error": "Tracker shard unavailable", "status": 502}] * len(parts[shard])
+        for position, result in zip(parts[shard], part_results):
+            results[position] = result
+
+    return jsonify({"results": results})
+
+
+@app.route('/list', methods=['GET'])
+def list_files():
+    """
+    List the files of every shard. Shards that don't answer are reported
+    in "unavailable_shards" rather than failing the whole listing.
+    """
+    def fetch(shard):
+        response = sessions[shard].get(shard + '/list', timeout=SHARD_TIMEOUT)
+        response.raise_for_status()
+        return response.json()["files"]
+
+    files = {}
+    unavailable = []
+    for shard, future in [(shard, fanout.submit(fetch, shard)) for shard in shards]:
+        try:
+            files.update(future.result())
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.error(f"Shard {shard} unavailable: {e}")
+            unavailable.append(shard)
+
+    response = {"files": files}
+    if unavailable:
+        response["unavailable_shards"] = unavailable
+    return jsonify(response)
+
+
+@app.route('/file/<file_id>', methods=['GET'])
+def get_file_info(file_id):
+    """
+    Get detailed information about a file from the shard that owns it
+    """
+    return route_to_owner(file_id, 'GET', f'/file/{file_id}', params=request.args)
+
+
+@app.route('/file/<file_id>/availability', methods=['GET'])
+def get_file_availability(file_id):
+    """
+    Get per-chunk availability of a file from the shard that owns it
+    """
+    return route_to_owner(file_id, 'GET', f'/file/{file_id}/availability', params=request.args)
+
+
+@app.route('/file/<file_id>/manifest', methods=['GET'])
+def get_file_manifest(file_id):
+    """
+    Get the piece-hash manifest of a file from the shard that owns it
+    """
+    return route_to_owner(file_id, 'GET', f'/file/{file_id}/manifest')
+
+
+@app.route('/generate_file_id', methods=['POST'])
+def generate_file_id():
+    """
+    Derive a file ID from a manifest; this needs no swarm state, so no shard is involved
+    """
+    payload, status = tracker_api.generate_file_id(request.get_json(silent=True) or {})
+    return jsonify(payload), status
+
+
+def spawn_shards(count, base_port, host='127.0.0.1', trust_proxy=True):
+    """
+    Start ``count`` app.py shard processes on ``host`` on consecutive
+    ports, each with its own snapshot and log, and wait until they answer.
+    With ``trust_proxy`` the shards take peer addresses from the
+    X-Forwarded-For header this router sets.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    processes = []
+    urls = []
+    for i in range(count):
+        port = base_port + i
+        env = dict(os.environ, TRACKER_DB=f"tracker_db.shard{i}.json",
+                   TRACKER_TRUST_PROXY="1" if trust_proxy else "0")
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(here, "app.py"), "--host", host, "--port", str(port)],
+            env=env
+        ))
+        urls.append(f"http://{host}:{port}")
+
+    # Take the shards down with the router, also when it is terminated
+    atexit.register(lambda: [process.terminate() for process in processes])
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    for url in urls:
+        deadline = time.time() + 15
+        while True:
+            try:
+                requests.get(url + '/list', timeout=1)
+                break
+            except requests.RequestException:
+                if time.time() > deadline:
+                    raise RuntimeError(f"Shard {url} did not start")
+                time.sleep(0.2)
+
+    return urls
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mini-Torrent sharded tracker router')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='Port to listen on')
+    parser.add_argument('--shard', action='append', default=[], help='URL of a running tracker shard (repeatable)')
+    parser.add_argument('--spawn', type=int, default=0, help='Start this many local shard processes')
+    parser.add_argument('--base-port', type=int, default=5001, help='Port of the first spawned shard')
+    parser.add_argument('--shard-host', type=str, default=None,
+                        help='Address spawned shards listen on and are reached at (default 127.0.0.1; '
+                             'required with --redirect)')
+    parser.add_argument('--redirect', action='store_true',
+                        help='Redirect per-file requests to their shard instead of proxying them')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    shard_urls = list(args.shard)
+    if args.spawn:
+        if args.redirect and args.shard_host is None:
+            parser.error("--redirect sends peers to the shards, so --spawn needs a --shard-host they can reach")
+        # Redirected peers reach the shards directly, so a forwarded address
+        # would be theirs to make up
+        shard_urls += spawn_shards(args.spawn, args.base_port, args.shard_host or '127.0.0.1',
+                                   trust_proxy=not args.redirect)
+    if not shard_urls:
+        parser.error("Give at least one --shard or --spawn N")
+
+    configure(shard_urls, use_redirects=args.redirect)
+    print(f"Routing {len(shard_urls)} shards: {', '.join(shard_urls)}")
+    app.run(host=args.host, port=args.port, threaded=True)
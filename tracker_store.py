@@ -0,0 +1,570 @@
+import heapq
+from array import array
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import bitfield
+import manifest
+
+# How often buffered log records are written out (seconds)
+FLUSH_INTERVAL = 1.0
+# Compact the log into a fresh snapshot after this many records
+SNAPSHOT_EVERY = 10000
+# Peers that haven't announced for this long are dropped (seconds)
+PEER_TIMEOUT = 300
+
+logger = logging.getLogger("TrackerStore")
+
+
+class TrackerStore:
+    """
+    In-memory tracker state persisted through an append-only change log.
+
+    The dict in ``self.files`` is the source of truth and keeps the same
+    structure that used to live in tracker_db.json. Every change is also
+    appended to a log as one JSON record per line; the log is written in
+    batches by a background thread so announces never wait on the disk.
+    Once the log grows past ``snapshot_every`` records it is folded into
+    a new snapshot and truncated. On startup the snapshot is loaded and
+    the log replayed on top of it.
+
+    Records only ever set state (never increment it), so replaying a
+    record that is already part of the snapshot is harmless. Peer records
+    that don't fit the file's chunk count (logged before a manifest
+    changed it) are skipped.
+
+    Peers expire ``peer_timeout`` seconds after their last announce. A
+    min-heap of ``(last_seen, file_id, peer_id)`` entries lets expiry pop
+    just the peers that are due instead of scanning every swarm; entries
+    left behind by a later announce are skipped when they surface. The
+    same background thread that flushes the log also runs expiry, and
+    readers call ``expire()`` first so they never see a stale peer. Each
+    file's ``peers`` dict therefore only holds live peers, kept in
+    ``last_seen`` order, and its length is the active-peer count.
+
+    Peer availability is held as packed bytes: ``seeder`` is True for
+    peers with the whole file (no bitfield is stored for them), otherwise
+    ``bitfield`` holds one bit per chunk. Bitfields are base64-encoded in
+    the log and snapshot. Between full announces a peer can send "have"
+    deltas with just its new chunks; ``seq`` is the number of the last
+    announce applied for the peer, so a lost delta shows up as a gap.
+
+    ``availability`` holds, per file, how many live seeders it has and an
+    array with the number of other live peers holding each chunk; the
+    replica count of chunk i is ``counts[i] + seeders``. It is derived
+    state, adjusted by every change and expiry rather than recounted, and
+    rebuilt on startup instead of being persisted.
+
+    ``peer_lists`` holds, per file, the IDs of its live peers in a list
+    plus each one's position in it, so announces can draw a random sample
+    of the swarm without copying it. Removal swaps the last ID into the
+    gap. Like ``availability`` it is derived state.
+    """
+
+    def __init__(self, snapshot_path="tracker_db.json", log_path=None,
+                 flush_interval=FLUSH_INTERVAL, snapshot_every=SNAPSHOT_EVERY,
+                 peer_timeout=PEER_TIMEOUT):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path or os.path.splitext(snapshot_path)[0] + ".log"
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.peer_timeout = peer_timeout
+
+        self.files = {}
+        self.availability = {}
+        self.peer_lists = {}
+        self.lock = threading.RLock()
+        self._io_lock = threading.Lock()
+        self._pending = []
+        self._records_since_snapshot = 0
+        self._log_torn = False
+        self._expiry = []
+
+        self._load()
+        self._log = open(self.log_path, "a", encoding="utf-8")
+
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._maintenance_loop, daemon=True)
+        self._worker.start()
+
+    # ------------------------------------------------------------------
+    # Loading and replay
+    # ------------------------------------------------------------------
+
+    def _load(self):
+        """Load the last snapshot and replay the change log on top of it"""
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                text = f.read()
+            if text.strip():
+                self.files = json.loads(text)
+                for file_id, file_info in self.files.items():
+                    self._load_file(file_info)
+                    self._init_availability(file_id)
+                    self.peer_lists[file_id] = ([], {})
+                    for peer_id, peer_info in file_info["peers"].items():
+                        self._update_availability(file_id, None, peer_info)
+                        self._add_to_peer_list(file_id, peer_id)
+
+        replayed = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn write, after a crash or a failed flush
+                        continue
+                    self._apply(record)
+                    replayed += 1
+
+        self._expiry = []
+        for file_id, file_info in self.files.items():
+            peers = sorted(file_info["peers"].items(), key=lambda item: item[1]["last_seen"])
+            file_info["peers"] = dict(peers)
+            for peer_id, peer_info in peers:
+                self._expiry.append((peer_info["last_seen"], file_id, peer_id))
+        heapq.heapify(self._expiry)
+        expired = self.expire()
+
+        if replayed or expired:
+            # Fold the replayed records into a fresh snapshot right away
+            self._write_snapshot(self._dump())
+            open(self.log_path, "w").close()
+
+    @classmethod
+    def _load_file(cls, file_info):
+        """Normalize a file entry read from a snapshot into its in-memory form"""
+        if isinstance(file_info["chunks"], list):
+            # Some clients used to send a chunk list instead of a count
+            file_info["chunks"] = len(file_info["chunks"])
+        if "piece_length" not in file_info:
+            # Files registered before piece lengths were chosen per file
+            if "manifest" in file_info:
+                file_info["piece_length"] = file_info["manifest"]["piece_length"]
+            else:
+                file_info["piece_length"] = manifest.DEFAULT_PIECE_LENGTH
+        for peer_info in file_info["peers"].values():
+            cls._load_peer(peer_info, file_info["chunks"])
+
+    @staticmethod
+    def _load_peer(peer_info, num_chunks):
+        """Turn the serialized availability of a peer entry into packed bytes"""
+        if "chunks" in peer_info:
+            # Entries written before bitfields stored index lists
+            chunks = peer_info.pop("chunks")
+            peer_info["seeder"] = not isinstance(chunks, list)
+            peer_info["bitfield"] = None if peer_info["seeder"] else bitfield.from_indices(chunks, num_chunks)
+        elif peer_info["bitfield"] is not None:
+            peer_info["bitfield"] = bitfield.decode(peer_info["bitfield"])
+        peer_info.setdefault("seq", 0)
+
+    def _init_availability(self, file_id):
+        """Start replica counting for a newly known file"""
+        self.availability[file_id] = self._empty_availability(self.files[file_id]["chunks"])
+
+    @staticmethod
+    def _empty_availability(num_chunks):
+        return {"seeders": 0, "counts": array("I", [0]) * num_chunks}
+
+    def _update_availability(self, file_id, old, new):
+        """
+        Adjust a file's replica counts for a peer entry going from ``old``
+        to ``new`` (either may be None), touching only the chunks that
+        changed hands
+        """
+        avail = self.availability[file_id]
+        counts = avail["counts"]
+        old_bits = new_bits = None
+
+        if old is not None:
+            if old["seeder"]:
+                avail["seeders"] -= 1
+            else:
+                old_bits = old["bitfield"]
+        if new is not None:
+            if new["seeder"]:
+                avail["seeders"] += 1
+            else:
+                new_bits = new["bitfield"]
+
+        if old_bits is not None:
+            removed = old_bits if new_bits is None else bitfield.difference(old_bits, new_bits)
+            for index in bitfield.iter_set(removed):
+                counts[index] -= 1
+        if new_bits is not None:
+            added = new_bits if old_bits is None else bitfield.difference(new_bits, old_bits)
+            for index in bitfield.iter_set(added):
+                counts[index] += 1
+
+    def _add_to_peer_list(self, file_id, peer_id):
+        peer_ids, positions = self.peer_lists[file_id]
+        positions[peer_id] = len(peer_ids)
+        peer_ids.append(peer_id)
+
+    def _remove_from_peer_list(self, file_id, peer_id):
+        peer_ids, positions = self.peer_lists[file_id]
+        position = positions.pop(peer_id)
+        last = peer_ids.pop()
+        if last != peer_id:
+            peer_ids[position] = last
+            positions[last] = position
+
+    def _apply(self, record):
+        """Apply a single change record to the in-memory state"""
+        op = record["op"]
+        if op == "file":
+            if record["file_id"] in self.files:
+                return
+            file_info = {
+                "filename": record["filename"],
+                "size": record["size"],
+                "created_at": record["created_at"],
+                "chunks": record["chunks"],
+                "peers": {}
+            }
+            if record.get("manifest"):
+                file_info["manifest"] = record["manifest"]
+            if record.get("piece_length"):
+                file_info["piece_length"] = record["piece_length"]
+            self._load_file(file_info)
+            # Build everything first, so a bad record can't leave a half-registered file
+            availability = self._empty_availability(file_info["chunks"])
+            self.files[record["file_id"]] = file_info
+            self.availability[record["file_id"]] = availability
+            self.peer_lists[record["file_id"]] = ([], {})
+        elif op == "manifest":
+            file_info = self.files.get(record["file_id"])
+            if file_info is None or "manifest" in file_info:
+                return
+            availability = self._empty_availability(record["chunks"])
+            if (record["size"], record["chunks"], record["piece_length"]) != \
+                    (file_info["size"], file_info["chunks"], file_info["piece_length"]):
+                # The peers' bitfields describe the chunks that were claimed
+                file_info["peers"] = {}
+                self.availability[record["file_id"]] = availability
+                self.peer_lists[record["file_id"]] = ([], {})
+            file_info["manifest"] = record["manifest"]
+            file_info["size"] = record["size"]
+            file_info["chunks"] = record["chunks"]
+            file_info["piece_length"] = record["piece_length"]
+        elif op == "peer":
+            file_info = self.files.get(record["file_id"])
+            if file_info is not None:
+                peer_info = {
+                    key: record[key]
+                    for key in ("ip", "port", "last_seen", "seeder", "bitfield", "seq", "chunks")
+                    if key in record
+                }
+                self._load_peer(peer_info, file_info["chunks"])
+                if not peer_info["seeder"] and len(peer_info["bitfield"]) != bitfield.size_for(file_info["chunks"]):
+                    # Logged before a manifest changed the file's chunk count
+                    return
+                # Re-insert so the dict stays ordered by last_seen
+                old = file_info["peers"].pop(record["peer_id"], None)
+                file_info["peers"][record["peer_id"]] = peer_info
+                self._update_availability(record["file_id"], old, peer_info)
+                if old is None:
+                    self._add_to_peer_list(record["file_id"], record["peer_id"])
+        elif op == "have":
+            file_info = self.files.get(record["file_id"])
+            if file_info is None or record["peer_id"] not in file_info["peers"]:
+                return
+            if not all(0 <= index < file_info["chunks"] for index in record["chunks"]):
+                # Logged before a manifest changed the file's chunk count
+                return
+            peer_info = file_info["peers"].pop(record["peer_id"])
+            if not peer_info["seeder"]:
+                counts = self.availability[record["file_id"]]["counts"]
+                for index in record["chunks"]:
+                    if not bitfield.has(peer_info["bitfield"], index):
+                        bitfield.set_bit(peer_info["bitfield"], index)
+                        counts[index] += 1
+                if bitfield.is_complete(peer_info["bitfield"], file_info["chunks"]):
+                    seeder_info = dict(peer_info, seeder=True, bitfield=None)
+                    self._update_availability(record["file_id"], peer_info, seeder_info)
+                    peer_info = seeder_info
+            peer_info["last_seen"] = record["last_seen"]
+            peer_info["seq"] = record["seq"]
+            file_info["peers"][record["peer_id"]] = peer_info
+
+    # ------------------------------------------------------------------
+    # Mutations
+    # ------------------------------------------------------------------
+
+    def _record(self, record):
+        """Apply a change and queue it for the log. Caller holds the lock."""
+        self._apply(record)
+        self._pending.append(json.dumps(record, separators=(",", ":")))
+
+    def add_file(self, file_id, filename, size, chunks, manifest=None, piece_length=None):
+        """
+        Register a file if the tracker doesn't know it yet, with its piece
+        length, optionally with its piece-hash manifest (in JSON form, see
+        manifest.py)
+        """
+        with self.lock:
+            if file_id in self.files:
+                return False
+            self._record({
+                "op": "file",
+                "file_id": file_id,
+                "filename": filename,
+                "size": size,
+                "created_at": time.time(),
+                "chunks": chunks,
+                "piece_length": piece_length,
+                "manifest": manifest
+            })
+            return True
+
+    def attach_manifest(self, file_id, manifest, size, chunks, piece_length):
+        """
+        Give a file registered without a manifest the one its ID was derived
+        from, taking the size, chunk count and piece length from it. If they
+        differ from what was registered, the file's peers are dropped.
+        Returns False if the file is unknown or already has a manifest.
+        """
+        with self.lock:
+            file_info = self.files.get(file_id)
+            if file_info is None or "manifest" in file_info:
+                return False
+            self._record({
+                "op": "manifest",
+                "file_id": file_id,
+                "manifest": manifest,
+                "size": size,
+                "chunks": chunks,
+                "piece_length": piece_length
+            })
+            return True
+
+    def update_peer(self, file_id, peer_id, ip, port, seeder, bits=None, seq=0):
+        """
+        Record that a peer is alive and which chunks it holds: either the
+        whole file (``seeder``) or the chunks set in ``bits``. Raises
+        ValueError if ``bits`` doesn't fit the file's chunk count, which a
+        manifest attached since the caller looked can have changed.
+        """
+        with self.lock:
+            if file_id not in self.files:
+                return False
+            num_chunks = self.files[file_id]["chunks"]
+            if not seeder and len(bits) != bitfield.size_for(num_chunks):
+                raise ValueError(f"Bitfield is {len(bits)} bytes, expected {bitfield.size_for(num_chunks)}")
+            now = time.time()
+            self._record({
+                "op": "peer",
+                "file_id": file_id,
+                "peer_id": peer_id,
+                "ip": ip,
+                "port": port,
+                "last_seen": now,
+                "seeder": seeder,
+                "bitfield": None if seeder else bitfield.encode(bits),
+                "seq": seq
+            })
+            heapq.heappush(self._expiry, (now, file_id, peer_id))
+            return True
+
+    def apply_have(self, file_id, peer_id, chunks, seq):
+        """
+        Add newly acquired chunks to a known peer's availability. Returns
+        False when the peer is unknown or ``seq`` doesn't directly follow
+        the last announce applied for it, in which case the peer has to
+        resync with a full announce.
+        """
+        with self.lock:
+            file_info = self.files.get(file_id)
+            if file_info is None:
+                return False
+            peer_info = file_info["peers"].get(peer_id)
+            if peer_info is None or peer_info["seq"] != seq - 1:
+                return False
+            if not all(0 <= index < file_info["chunks"] for index in chunks):
+                # The file's chunk count changed since the caller checked
+                return False
+            now = time.time()
+            self._record({
+                "op": "have",
+                "file_id": file_id,
+                "peer_id": peer_id,
+                "last_seen": now,
+                "chunks": chunks,
+                "seq": seq
+            })
+            heapq.heappush(self._expiry, (now, file_id, peer_id))
+            return True
+
+    def expire(self, now=None):
+        """Drop peers whose last announce is older than the timeout"""
+        cutoff = (now or time.time()) - self.peer_timeout
+        expired = 0
+        with self.lock:
+            while self._expiry and self._expiry[0][0] <= cutoff:
+                last_seen, file_id, peer_id = heapq.heappop(self._expiry)
+                file_info = self.files.get(file_id)
+                if file_info is None:
+                    continue
+                peer_info = file_info["peers"].get(peer_id)
+                # Skip entries superseded by a newer announce
+                if peer_info is None or peer_info["last_seen"] != last_seen:
+                    continue
+                del file_info["peers"][peer_id]
+                self._update_availability(file_id, peer_info, None)
+                self._remove_from_peer_list(file_id, peer_id)
+                expired += 1
+        return expired
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def sample_peers(self, file_id, numwant, exclude=None, seeder=False, bits=None):
+        """
+        Choose up to ``numwant`` peers of a file worth handing to a
+        requester that holds ``bits`` (or everything, if ``seeder``).
+
+        Only a bounded candidate pool is scored: the most recently active
+        peers plus a random sample of the swarm. Candidates are ranked by
+        how many chunks they hold that the requester lacks, and a quarter
+        of the slots each go to recently active peers and, for leechers,
+        to seeders so responses don't all point at the same few peers.
+        Returns a list of (peer_id, peer_info) pairs.
+        """
+        if numwant <= 0:
+            return []
+        with self.lock:
+            file_info = self.files[file_id]
+            peers = file_info["peers"]
+            if len(peers) - (exclude in peers) <= numwant:
+                return [(pid, info) for pid, info in peers.items() if pid != exclude]
+
+            all_chunks = int.from_bytes(bitfield.full(file_info["chunks"]), "big")
+            if seeder:
+                wanted = 0
+            else:
+                wanted = all_chunks & ~int.from_bytes(bits or b"", "big")
+
+            recent = [pid for pid in itertools.islice(reversed(peers), numwant + 1) if pid != exclude]
+            pool = set(recent)
+            peer_ids = self.peer_lists[file_id][0]
+            pool.update(random.sample(peer_ids, min(len(peer_ids), 2 * numwant)))
+            pool.discard(exclude)
+
+            def useful(pid):
+                info = peers[pid]
+                held = all_chunks if info["seeder"] else int.from_bytes(info["bitfield"], "big")
+                return (held & wanted).bit_count()
+
+            ranked = sorted(pool, key=lambda pid: (useful(pid), peers[pid]["last_seen"]), reverse=True)
+
+            chosen = dict.fromkeys(recent[:numwant // 4])
+            if not seeder:
+                seeders = [pid for pid in ranked if peers[pid]["seeder"]]
+                chosen.update(dict.fromkeys(seeders[:numwant // 4]))
+            for pid in ranked:
+                if len(chosen) >= numwant:
+                    break
+                chosen.setdefault(pid)
+
+            return [(pid, peers[pid]) for pid in chosen]
+
+    def chunk_availability(self, file_id):
+        """
+        Return (seeders, counts) for a file, where counts is a copy of the
+        per-chunk number of non-seeding peers holding each chunk, or None
+        if the file is unknown
+        """
+        with self.lock:
+            avail = self.availability.get(file_id)
+            if avail is None:
+                return None
+            return avail["seeders"], array("I", avail["counts"])
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def _maintenance_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            # This thread is the only one persisting changes, so it must
+            # outlive a failed pass (e.g. a full disk) and try again
+            try:
+                self.expire()
+                self.flush()
+            except Exception:
+                logger.exception("Tracker store maintenance failed")
+
+    def flush(self):
+        """
+        Write buffered records to the log, compacting it when it gets long.
+        The store lock is only held to take the buffered records and, one
+        file at a time, to serialize a snapshot; the disk writes happen
+        outside it, so request handling never waits on I/O or on a whole
+        snapshot being serialized.
+        """
+        with self._io_lock:
+            with self.lock:
+                pending, self._pending = self._pending, []
+            if pending:
+                try:
+                    # After a failed write, start on a fresh line so the
+                    # records don't run on from a torn one
+                    self._log.write("\n" * self._log_torn + "\n".join(pending) + "\n")
+                    self._log.flush()
+                except OSError:
+                    # Keep the records for the next attempt
+                    self._log_torn = True
+                    with self.lock:
+                        self._pending[:0] = pending
+                    raise
+                self._log_torn = False
+                self._records_since_snapshot += len(pending)
+            if self._records_since_snapshot < self.snapshot_every:
+                return
+
+            snapshot = self._dump()
+            self._write_snapshot(snapshot)
+            # Every record in the log is covered by the snapshot now. Ones
+            # buffered since, including changes made while the snapshot was
+            # being serialized, are logged later, which replay tolerates.
+            self._log.seek(0)
+            self._log.truncate()
+            self._records_since_snapshot = 0
+
+    def _dump(self):
+        """
+        Serialize the current state as a snapshot. The lock is taken per
+        file, so files may be caught at slightly different moments; every
+        change made in between is still buffered for the log.
+        """
+        with self.lock:
+            file_ids = list(self.files)
+        parts = []
+        for file_id in file_ids:
+            with self.lock:
+                parts.append(json.dumps(file_id) + ":" + json.dumps(self.files[file_id], default=bitfield.encode))
+        return "{" + ",".join(parts) + "}"
+
+    def _write_snapshot(self, snapshot):
+        """Atomically replace the snapshot file"""
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+    def close(self):
+        """Stop the background thread and write out anything still buffered"""
+        self._stop.set()
+        self._worker.join()
+        self.flush()
+        with self._io_lock:
+            self._log.close()